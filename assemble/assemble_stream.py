@@ -1,9 +1,26 @@
-import os, logging, io, json, random, shutil, subprocess, re
+import os, logging, io, json, random, shutil, subprocess, re, math, hashlib, tempfile, time
 import boto3
 from botocore.exceptions import ClientError
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
 
-BYTES_PER_SEC = 1 << 14 # 128k mono MP3 audio
+BYTES_PER_SEC = 1 << 14 # 128k MP3 audio
+
+# MPEG audio layer III header tables, keyed by the header's version bits
+# (3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5)
+MP3_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    0: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+MP3_GRANULE_SAMPLES = 576
+
+# bump this to invalidate every cached segment after changing how they're made
+SEGMENT_CACHE_VERSION = 3
 
 def get_config():
     return {
@@ -11,9 +28,51 @@ def get_config():
         "cue_prefix": "cues/",
         "mp3_prefix": "archive/",
         "catalog": "archive/catalog.json",
+        "catalog_manifest": "archive/catalog/manifest.json",
+        # broadcast ID -> [length, trim start, trim end] is read from the
+        # per-year trims shards listed in the catalog manifest, written by
+        # catalog_forecast (tools/build-catalog.py backfills older years);
+        # broadcasts missing from them fall back to their cues
+        # broadcasts shorter than this once trimmed are never picked
+        "min_broadcast_secs": 2 * 60,
         "stream_key": "stream.mp3",
         "default_length": 45 * 60,
-        "fade_secs": 5
+        "fade_secs": 5,
+        # "copy" cuts frames out of the archive MP3 and fades them in place,
+        # falling back to "encode" (a full ffmpeg re-encode) when it can't,
+        # or when the broadcast doesn't have stream_channels channels
+        "trim_mode": "copy",
+        # every broadcast in the stream is 128k MP3 with this many channels,
+        # so players never see the channel mode change mid-stream
+        "stream_channels": 1,
+        # "segments" trims each broadcast separately and joins the results;
+        # "graph" renders the whole stream with a single ffmpeg filter graph
+        "engine": "segments",
+        # "mp3" replaces stream_key every run; "hls" appends the new audio to
+        # a rolling HLS playlist under hls_prefix, aging out the oldest
+        # segments once the playlist is longer than hls_window_secs
+        "output": "mp3",
+        "hls_prefix": "hls/",
+        "hls_segment_secs": 10,
+        "hls_window_secs": 3 * 60 * 60,
+        # playlists are cached for this long, so aged-out segments are kept
+        # at least this long after leaving them
+        "hls_playlist_max_age": 60,
+        # broadcasts played in the last recent_runs runs aren't picked again
+        "recent_key": "cache/recent.json",
+        "recent_runs": 7,
+        # relative odds of picking each broadcast time, e.g. {"0048": 2}
+        "timing_weights": None,
+        # how many picked broadcasts to fetch ahead of the one being encoded
+        "prefetch_depth": 3,
+        "prefetch_workers": 4,
+        # trimmed segments are cached in S3, or in a local directory when
+        # not running in production
+        "segment_cache_prefix": "cache/segments/",
+        "segment_cache_dir": "segment-cache",
+        "segment_cache_max_bytes": 1 << 30,
+        # the stream is uploaded in parts of this size as it's assembled
+        "upload_part_size": 8 << 20
     }
 
 def set_log_level():
@@ -26,28 +85,107 @@ def in_production():
 
 
 def download_file(bucket, key):
+    # Goes through the client rather than the resource, since this runs in
+    # the prefetch threads and only clients are thread-safe
     logging.info(f"Downloading {key} from {bucket.name}")
     try:
         buffer = io.BytesIO()
-        bucket.download_fileobj(key, buffer)
+        bucket.meta.client.download_fileobj(bucket.name, key, buffer)
         buffer.seek(0)
     except ClientError as e:
         logging.error(f"Can't download {key}: {e}")
     return buffer
 
 
-def upload_file(bucket, key, fileobj):
+class MultipartUpload:
+    # File-like sink that sends what's written to it to S3 as the parts of a
+    # multipart upload, so at most one part is ever held in memory
+
+    def __init__(self, bucket, key, part_size, **extra_args):
+        self.client = bucket.meta.client
+        self.bucket, self.key, self.part_size = bucket.name, key, part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        response = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, **extra_args)
+        self.upload_id = response["UploadId"]
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(self.part_size)
+        return len(data)
+
+    def upload_part(self, length):
+        body = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self.upload_part(len(self.buffer))
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            logging.error(f"Aborting upload of {self.key}: {exc}")
+            self.abort()
+
+
+class LocalUpload:
+    # Stands in for MultipartUpload when not running in production
+
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+
+
+def open_upload(bucket, key, part_size, content_type):
     logging.info(f"Uploading {key} to {bucket.name}")
-    # buffer = io.BytesIO(json.dumps(data).encode("utf-8"))
     if in_production():
+        return MultipartUpload(bucket, key, part_size,
+                               ACL="public-read", ContentType=content_type)
+    logging.info("(Not running in production, so saving locally instead)")
+    return LocalUpload(os.path.basename(key))
+
+
+def upload_file(bucket, key, fileobj, **extra_args):
+    if in_production():
+        logging.info(f"Uploading {key} to {bucket.name}")
         try:
             bucket.upload_fileobj(fileobj, key, ExtraArgs={
-                                  "ACL": "public-read"})
+                                  "ACL": "public-read", **extra_args})
         except ClientError as e:
             logging.error(f"Can't upload to {bucket}: {e}")
     else:
-        logging.info("(Not running in production, so saving locally instead)")
-        with open(os.path.basename(key), "wb") as output:
+        with open_upload(bucket, key, None, None) as output:
             shutil.copyfileobj(fileobj, output)
 
 
@@ -56,28 +194,279 @@ def download_json(bucket, key):
     return json.load(buffer)
 
 
+def load_manifest(bucket, config):
+    buffer = io.BytesIO()
+    try:
+        bucket.download_fileobj(config["catalog_manifest"], buffer)
+    except ClientError as e:
+        logging.info(f"Can't read {config['catalog_manifest']}, so reading {config['catalog']}: {e}")
+        return None
+    return json.loads(buffer.getvalue())
+
+
+def load_catalog(bucket, config, manifest):
+    # Reads the year shards listed in the catalog manifest, or the old
+    # single-file catalog if there's no manifest yet
+    if manifest is None:
+        return download_json(bucket, config["catalog"])
+    shards = manifest["shards"]
+    with ThreadPoolExecutor(max_workers=config["prefetch_workers"]) as executor:
+        keys = [shards[year]["key"] for year in shards]
+        return dict(zip(shards, executor.map(lambda key: download_json(bucket, key), keys)))
+
+
+def load_json(bucket, key):
+    buffer = io.BytesIO()
+    try:
+        bucket.meta.client.download_fileobj(bucket.name, key, buffer)
+    except ClientError as e:
+        logging.info(f"Can't read {key}: {e}")
+        return None
+    return json.loads(buffer.getvalue())
+
+
+def load_trims(bucket, config, manifest):
+    # Reads the trims shards listed in the manifest
+    keys = [entry["trims"] for entry in (manifest or {}).get("shards", {}).values() if "trims" in entry]
+    with ThreadPoolExecutor(max_workers=config["prefetch_workers"]) as executor:
+        shards = list(executor.map(lambda key: load_json(bucket, key), keys))
+    trims = {}
+    for shard in shards:
+        trims.update(shard or {})
+    if not trims:
+        logging.info("No trims, so reading cues for every broadcast")
+    return trims
+
+
 def get_bucket(config):
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(config["bucket"])
     return bucket
 
 
-def get_random_file(catalog):
-    def pick(x): return random.choice(list(x.keys()))
-    yr = pick(catalog)
-    mo = pick(catalog[yr])
-    day = pick(catalog[yr][mo])
-    timing = random.choice(catalog[yr][mo][day])
-    return f"{yr}{mo}{day}Z{timing}.mp3"
+def get_etag(bucket, key):
+    try:
+        return bucket.meta.client.head_object(Bucket=bucket.name, Key=key)["ETag"]
+    except ClientError as e:
+        logging.error(f"Can't get ETag of {key}: {e}")
+        return None
+
+
+class SegmentCache:
+    # Trimmed segments keyed by a hash of everything that went into them,
+    # evicted least recently used first once they outgrow max_bytes. On its
+    # own this caches nothing.
+
+    def read(self, key):
+        return None
+
+    def write(self, key, data):
+        pass
+
+    def entries(self):
+        return []
+
+    def get(self, key):
+        return self.read(key) if key else None
+
+    def put(self, key, data):
+        if key and data:
+            self.write(key, data)
+
+    def evict(self, max_bytes):
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        expired = []
+        while entries and total > max_bytes:
+            key, size, _ = entries.pop(0)
+            expired.append(key)
+            total -= size
+        if expired:
+            logging.info(f"Evicting {len(expired)} cached segments")
+            self.remove(expired)
+
+
+class S3SegmentCache(SegmentCache):
+    def __init__(self, bucket, prefix):
+        self.bucket, self.prefix = bucket, prefix
+
+    def read(self, key):
+        # Called from the prefetch threads, so through the client
+        client, name = self.bucket.meta.client, self.bucket.name
+        buffer = io.BytesIO()
+        try:
+            client.download_fileobj(name, self.prefix + key, buffer)
+            # Copying the object onto itself bumps LastModified for the LRU
+            client.copy_object(Bucket=name, Key=self.prefix + key,
+                               CopySource={"Bucket": name, "Key": self.prefix + key},
+                               MetadataDirective="REPLACE")
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                logging.error(f"Can't read cached segment {key}: {e}")
+            return None
+        return buffer.getvalue()
+
+    def write(self, key, data):
+        try:
+            self.bucket.upload_fileobj(io.BytesIO(data), self.prefix + key)
+        except ClientError as e:
+            logging.error(f"Can't cache segment {key}: {e}")
+
+    def entries(self):
+        for obj in self.bucket.objects.filter(Prefix=self.prefix):
+            yield obj.key[len(self.prefix):], obj.size, obj.last_modified
+
+    def remove(self, keys):
+        for i in range(0, len(keys), 1000):
+            self.bucket.delete_objects(Delete={
+                "Objects": [{"Key": self.prefix + key} for key in keys[i:i + 1000]]})
+
+
+class LocalSegmentCache(SegmentCache):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def read(self, key):
+        filename = os.path.join(self.path, key)
+        if not os.path.exists(filename):
+            return None
+        os.utime(filename)
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def write(self, key, data):
+        with open(os.path.join(self.path, key), "wb") as f:
+            f.write(data)
+
+    def entries(self):
+        for entry in os.scandir(self.path):
+            stat = entry.stat()
+            yield entry.name, stat.st_size, stat.st_mtime
+
+    def remove(self, keys):
+        for key in keys:
+            os.remove(os.path.join(self.path, key))
+
+
+def get_segment_cache(config, bucket):
+    if in_production():
+        return S3SegmentCache(bucket, config["segment_cache_prefix"])
+    return LocalSegmentCache(config["segment_cache_dir"])
+
+
+def segment_cache_key(config, key, etag, start, end):
+    if not etag:
+        return None
+    # The bitrate is baked into trim_audio_stream
+    fields = [SEGMENT_CACHE_VERSION, key, etag, start, end,
+              config["fade_secs"], config["trim_mode"], "128k", config["stream_channels"]]
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest() + ".mp3"
+
+
+class BroadcastIndex:
+    # Every broadcast in the catalog, flattened once into a sorted list of
+    # IDs like "20240101Z0048"
+
+    def __init__(self, catalog, skip=()):
+        self.ids = sorted({
+            f"{yr}{mo}{day}Z{timing}"
+            for yr, months in catalog.items()
+            for mo, days in months.items()
+            for day, timings in days.items()
+            for timing in timings} - set(skip))
+
+    def last(self, timing="0048"):
+        for broadcast in reversed(self.ids):
+            if broadcast.endswith(timing):
+                return broadcast
+        return self.ids[-1]
+
+    def sample(self, rng, exclude=(), weights=None):
+        # Yields broadcasts in random order without replacement, starting
+        # over once every broadcast has been used. Each pick is uniform over
+        # what's left, or in proportion to weights[timing] if given.
+        while True:
+            pools = {}
+            for broadcast in self.ids:
+                if broadcast not in exclude:
+                    pools.setdefault(broadcast[-4:], []).append(broadcast)
+            if not pools:
+                exclude = ()
+                continue
+            while pools:
+                timings = sorted(pools)
+                odds = [len(pools[t]) * (weights or {}).get(t, 1) for t in timings]
+                timing = rng.choices(timings, odds)[0]
+                pool = pools[timing]
+                i = rng.randrange(len(pool))
+                pool[i], pool[-1] = pool[-1], pool[i]
+                yield pool.pop()
+                if not pool:
+                    del pools[timing]
+            logging.info("Every broadcast has been picked, so starting over")
+            exclude = ()
+
+
+def get_last_file(index):
+    return index.last() + ".mp3"
+
 
+def pick_files(index, rng, recent=(), weights=None, picked=None):
+    # Starts with the latest midnight broadcast, then random ones that
+    # haven't been played recently, recording each pick in picked
+    first = get_last_file(index)
+    broadcasts = index.sample(rng, set(recent) | {first[:-4]}, weights)
+    for file in chain([first], (broadcast + ".mp3" for broadcast in broadcasts)):
+        if picked is not None:
+            picked.append(file[:-4])
+        yield file
+
+
+def load_recent(bucket, key):
+    buffer = io.BytesIO()
+    try:
+        bucket.download_fileobj(key, buffer)
+    except ClientError as e:
+        logging.info(f"Can't read {key}, so nothing counts as recently played: {e}")
+        return []
+    return json.loads(buffer.getvalue())
+
+
+def get_short_broadcasts(trims, min_secs):
+    return {broadcast for broadcast, (_, start, end) in trims.items() if end - start < min_secs}
+
+
+def fetch_broadcast(bucket, config, cache, trims, file):
+    if file[:-4] in trims:
+        _, start, end = trims[file[:-4]]
+    else:
+        cue_data = download_json(bucket, config["cue_prefix"] + file + ".json")
+        start, end = get_forecast_cues(cue_data)
+    key = config["mp3_prefix"] + file
+    cache_key = segment_cache_key(config, key, get_etag(bucket, key), start, end)
+    segment = cache.get(cache_key)
+    audio = download_file(bucket, key) if segment is None else None
+    return file, start, end, cache_key, segment, audio
+
+
+def prefetch_broadcasts(bucket, config, cache, trims, files):
+    # Yields fetch_broadcast results in the same order as files, while the
+    # next prefetch_depth files are downloaded in the background
+    executor = ThreadPoolExecutor(max_workers=config["prefetch_workers"])
+    pending = deque()
+    try:
+        for file in files:
+            pending.append(executor.submit(fetch_broadcast, bucket, config, cache, trims, file))
+            if len(pending) > config["prefetch_depth"]:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
 
-def get_last_file(catalog):
-    def pick(x): return list(sorted(x.keys()))[-1]
-    yr = pick(catalog)
-    mo = pick(catalog[yr])
-    day = pick(catalog[yr][mo])
-    timing = "0048" # catalog[yr][mo][day][-1]
-    return f"{yr}{mo}{day}Z{timing}.mp3"
 
 def get_forecast_cues(data, spacing_secs=5):
     duration = data["length"]
@@ -111,7 +500,191 @@ def get_forecast_cues(data, spacing_secs=5):
     return (start, end)
 
 
-def trim_audio_stream(data, start, end, fade_secs=5):
+def side_info_length(mpeg1, channels):
+    if mpeg1:
+        return 17 if channels == 1 else 32
+    return 9 if channels == 1 else 17
+
+
+def parse_mp3_frames(data):
+    # Returns the (offset, size) of every MPEG audio frame in data, along with
+    # the sample rate, samples per frame and number of channels. Raises
+    # ValueError unless the stream is CBR 128k layer III, which is what both
+    # the recorder and trim_audio_stream encode. A LAME Info/Xing frame at
+    # the start of a file describes the whole file and holds no audio, so
+    # it's left out.
+    frames = []
+    stream_format = None
+    pos = 0
+    file_start = True
+    while pos + 4 <= len(data):
+        if data[pos:pos + 3] == b"ID3":
+            # ID3v2 tags appear wherever ffmpeg was restarted mid-recording
+            size = 0
+            for b in data[pos + 6:pos + 10]:
+                size = (size << 7) | (b & 0x7f)
+            pos += 10 + size + (10 if data[pos + 5] & 0x10 else 0)
+            file_start = True
+            continue
+        if data[pos:pos + 3] == b"TAG" and len(data) - pos <= 128:
+            break
+        header = int.from_bytes(data[pos:pos + 4], "big")
+        version = (header >> 19) & 3
+        layer = (header >> 17) & 3
+        bitrate_index = (header >> 12) & 15
+        rate_index = (header >> 10) & 3
+        if header >> 21 != 0x7ff or version == 1 or layer != 1 \
+                or bitrate_index in (0, 15) or rate_index == 3:
+            # Lost sync, most likely after a truncated frame: drop the frame
+            # that ran into the garbage and skip ahead to the next header
+            resync = data.find(b"\xff", pos + 1)
+            if resync < 0:
+                break
+            if frames and frames[-1][0] + frames[-1][1] == pos:
+                frames.pop()
+            pos = resync
+            continue
+        crc = not (header >> 16) & 1
+        channels = 1 if (header >> 6) & 3 == 3 else 2
+        bitrate = MP3_BITRATES[version][bitrate_index]
+        sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+        size = (144 if version == 3 else 72) * bitrate * 1000 // sample_rate + ((header >> 9) & 1)
+        if file_start:
+            file_start = False
+            tag_offset = pos + 4 + side_info_length(version == 3, channels)
+            if data[tag_offset:tag_offset + 4] in (b"Xing", b"Info") or \
+                    data[pos + 36:pos + 40] == b"VBRI":
+                pos += size
+                continue
+        if bitrate != 128 or crc:
+            raise ValueError(f"Frame at byte {pos} isn't CBR 128k without CRC")
+        if stream_format is None:
+            stream_format = (version, sample_rate, channels)
+        elif stream_format != (version, sample_rate, channels):
+            raise ValueError(f"Frame at byte {pos} changes the sample rate or channels")
+        if pos + size > len(data):
+            break
+        frames.append((pos, size))
+        pos += size
+    if not frames:
+        raise ValueError("No MP3 frames found")
+    version, sample_rate, channels = stream_format
+    return frames, sample_rate, 1152 if version == 3 else 576, channels
+
+
+def scale_mp3_frame(frame, gains, mpeg1=True, channels=1):
+    # Rewrites the side info of a layer III frame in place, lowering each
+    # granule's global_gain in every channel by the given number of 1.5dB
+    # steps. A gain of None silences the granule, and a frame with all
+    # granules silenced no longer reads anything from the bit reservoir.
+    # Mid/side and intensity stereo channels scale together, so joint stereo
+    # fades the same way.
+    side_len = side_info_length(mpeg1, channels)
+    if mpeg1:
+        granule_start = 18 if channels == 1 else 20
+        granule_bits, compress_bits = 59, 4
+    else:
+        granule_start = 9 if channels == 1 else 10
+        granule_bits, compress_bits = 63, 9
+    nbits = side_len * 8
+    side = int.from_bytes(frame[4:4 + side_len], "big")
+
+    def field(offset, width, value=None):
+        nonlocal side
+        shift = nbits - offset - width
+        mask = ((1 << width) - 1) << shift
+        if value is None:
+            return (side & mask) >> shift
+        side = (side & ~mask) | (value << shift)
+
+    for granule, gain in enumerate(gains):
+        for channel in range(channels):
+            offset = granule_start + (granule * channels + channel) * granule_bits
+            if gain is None:
+                field(offset, 12, 0)  # part2_3_length
+                field(offset + 12, 9, 0)  # big_values
+                field(offset + 21, 8, 0)  # global_gain
+                field(offset + 29, compress_bits, 0)  # scalefac_compress
+            elif gain:
+                field(offset + 21, 8, max(0, field(offset + 21, 8) - gain))
+    if all(gain is None for gain in gains):
+        field(0, 9 if mpeg1 else 8, 0)  # main_data_begin
+    frame[4:4 + side_len] = side.to_bytes(side_len, "big")
+
+
+def main_data_begin(frame, mpeg1=True):
+    if mpeg1:
+        return (frame[4] << 1) | (frame[5] >> 7)
+    return frame[4]
+
+
+def copy_audio_stream(data, start, end, fade_secs=5, channels=1):
+    # Cuts [start, end] out of an MP3 stream on frame boundaries without
+    # decoding it. Frames inside the fades have their global_gain stepped
+    # down, and frames whose bit reservoir data lies before the cut are
+    # silenced, so the result can follow any other MP3 stream with the same
+    # number of channels. Raises ValueError if the source has a different
+    # number.
+    frames, sample_rate, frame_samples, source_channels = parse_mp3_frames(data)
+    if source_channels != channels:
+        raise ValueError(f"Source has {source_channels} channels, not {channels}")
+    mpeg1 = frame_samples == 1152
+    side_len = side_info_length(mpeg1, channels)
+    frame_secs = frame_samples / sample_rate
+    granule_secs = MP3_GRANULE_SAMPLES / sample_rate
+    first = int(start / frame_secs)
+    last = min(len(frames), math.ceil(end / frame_secs))
+    if last - first < 2 * fade_secs / frame_secs:
+        raise ValueError(f"Only {last - first} frames between {start}s and {end}s")
+    logging.info(f"Copying {end - start}s of MP3 audio")
+    duration = (last - first) * frame_secs
+
+    def gain(t):
+        amplitude = min(1.0, t / fade_secs, (duration - t) / fade_secs)
+        if amplitude <= 0:
+            return None
+        # global_gain steps are 2^(1/4) in amplitude
+        return round(-4 * math.log2(amplitude))
+
+    view = memoryview(data)
+    output = []
+    run_start = run_end = None
+    reservoir = 0  # bytes of main data since the cut
+    for i in range(first, last):
+        offset, size = frames[i]
+        t = (i - first) * frame_secs
+        fading = t < fade_secs or t + frame_secs > duration - fade_secs
+        orphaned = main_data_begin(view[offset:offset + 6], mpeg1) > reservoir
+        reservoir += size - 4 - side_len
+        if not fading and not orphaned:
+            if run_end != offset:
+                if run_start is not None:
+                    output.append(view[run_start:run_end])
+                run_start = offset
+            run_end = offset + size
+            continue
+        if run_start is not None:
+            output.append(view[run_start:run_end])
+            run_start = run_end = None
+        frame = bytearray(view[offset:offset + size])
+        if orphaned:
+            gains = [None] * (frame_samples // MP3_GRANULE_SAMPLES)
+        else:
+            gains = [gain(t + (g + 0.5) * granule_secs)
+                     for g in range(frame_samples // MP3_GRANULE_SAMPLES)]
+        scale_mp3_frame(frame, gains, mpeg1, channels)
+        output.append(frame)
+    if run_start is not None:
+        output.append(view[run_start:run_end])
+    return b"".join(output)
+
+
+def trim_audio_stream(data, start, end, fade_secs=5, mode="encode", channels=1):
+    if mode == "copy":
+        try:
+            return copy_audio_stream(data, start, end, fade_secs, channels)
+        except ValueError as e:
+            logging.warning(f"Can't copy MP3 frames ({e}), so re-encoding instead")
     # ffmpeg -ss 10 -to 25 -i - -b:a 128k -ac 1 -af "afade=t=in:st=0:d=5,afade=t=out:st=10:d=5" -f mp3 -
     logging.info(f"Re-encoding {end - start}s of MP3 audio")
     fade_start = end - start - fade_secs
@@ -123,8 +696,8 @@ def trim_audio_stream(data, start, end, fade_secs=5):
             '-to', str(end),
             # read from STDIN
             '-i', '-',
-            # downmix to mono
-            '-ac', '1',
+            # mix to the stream's channels
+            '-ac', str(channels),
             # set bitrate
             '-ab', '128k',
             # apply an audio filter to fade in and out
@@ -139,6 +712,61 @@ def trim_audio_stream(data, start, end, fade_secs=5):
         logging.error(f"ffmpeg returned {process.returncode}: {err}")
     return output
 
+def get_mp3_sample_rate(filename, default=44100):
+    # The sample rate in the first MPEG audio frame header of the file
+    with open(filename, "rb") as f:
+        data = f.read(10)
+        if data[:3] == b"ID3":
+            size = 0
+            for b in data[6:10]:
+                size = (size << 7) | (b & 0x7f)
+            f.seek(10 + size)
+        else:
+            f.seek(0)
+        data = f.read(1 << 16)
+    pos = data.find(b"\xff")
+    while 0 <= pos <= len(data) - 4:
+        header = int.from_bytes(data[pos:pos + 4], "big")
+        version = (header >> 19) & 3
+        layer = (header >> 17) & 3
+        rate_index = (header >> 10) & 3
+        if header >> 21 == 0x7ff and version != 1 and layer == 1 and rate_index != 3:
+            return MP3_SAMPLE_RATES[version][rate_index]
+        pos = data.find(b"\xff", pos + 1)
+    return default
+
+def render_broadcasts(plan, fade_secs, output, channels=1):
+    # Trims, fades and joins every (filename, start, end) in plan with one
+    # ffmpeg process, writing the MP3 stream to output as it's encoded.
+    # Raises CalledProcessError if ffmpeg fails, so the upload is abandoned
+    # rather than replacing the stream with a truncated one.
+    if not plan:
+        raise ValueError("No broadcasts to render")
+    args = ['ffmpeg', '-loglevel', 'error']
+    filters = []
+    sample_rate = get_mp3_sample_rate(plan[0][0])
+    layout = "mono" if channels == 1 else "stereo"
+    for i, (filename, start, end) in enumerate(plan):
+        fade_start = end - start - fade_secs
+        args += ['-ss', str(start), '-to', str(end), '-i', filename]
+        # concat needs every input in the same format, so they're all
+        # resampled to the first one's rate and mixed to the stream's channels
+        filters.append(
+            f"[{i}:a]aformat=sample_rates={sample_rate}:channel_layouts={layout},"
+            f"afade=t=in:st=0:d={fade_secs},afade=t=out:st={fade_start}:d={fade_secs}[a{i}]")
+    inputs = "".join(f"[a{i}]" for i in range(len(plan)))
+    filters.append(f"{inputs}concat=n={len(plan)}:v=0:a=1[out]")
+    args += ['-filter_complex', ";".join(filters), '-map', '[out]',
+             '-ac', str(channels), '-ab', '128k', '-f', 'mp3', '-']
+    logging.info(f"Rendering {len(plan)} broadcasts with a single ffmpeg process")
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    for chunk in iter(lambda: process.stdout.read(1 << 16), b""):
+        output.write(chunk)
+    process.wait()
+    if process.returncode != 0:
+        logging.error(f"ffmpeg returned {process.returncode}")
+        raise subprocess.CalledProcessError(process.returncode, args)
+
 def get_broadcast_time(file):
     m = re.match(r'.*\b(....)(..)(..)Z(..)(..).mp3$', file)
     if not m:
@@ -157,31 +785,223 @@ def generate_vtt_file(text_cues):
         buffer += timing + "\n\n"
     return io.BytesIO(buffer.encode("utf-8"))
 
+def vtt_time(secs):
+    return f"{int(secs) // 3600:02d}:{int(secs) // 60 % 60:02d}:{secs % 60:06.3f}"
+
+def generate_vtt_segment(text_cues, start, end):
+    # ffmpeg's MPEG-TS muxer starts each run's timestamps at 1.4s
+    buffer = "WEBVTT\nX-TIMESTAMP-MAP=MPEGTS:126000,LOCAL:00:00:00.000\n\n"
+    for cue_start, cue_end, timing in text_cues:
+        if cue_start < end and cue_end > start:
+            buffer += f"{vtt_time(cue_start)} --> {vtt_time(cue_end)}\n"
+            buffer += timing + "\n\n"
+    return io.BytesIO(buffer.encode("utf-8"))
+
+def segment_hls(filename, work_dir, segment_secs, first_sequence):
+    # Splits the MP3 into MPEG-TS segments numbered from first_sequence, and
+    # returns the (name, duration) of each
+    index = os.path.join(work_dir, "index.m3u8")
+    subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-i', filename, '-c', 'copy',
+            '-f', 'hls', '-hls_time', str(segment_secs), '-hls_list_size', '0',
+            '-start_number', str(first_sequence),
+            '-hls_segment_filename', os.path.join(work_dir, 'seg%06d.ts'), index],
+        check=True)
+    segments = []
+    with open(index) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line and not line.startswith("#"):
+                segments.append((line, duration))
+    return segments
+
+def generate_hls_playlist(state, extension, segment_secs):
+    # A live sliding-window playlist: segments are added and aged out every
+    # run, so there's no EXT-X-ENDLIST (or EXT-X-PLAYLIST-TYPE) and players
+    # keep reloading it
+    segments = state["segments"]
+    target = math.ceil(max((segment["duration"] for segment in segments), default=segment_secs))
+    first_sequence = segments[0]["sequence"] if segments else state["next_sequence"]
+    buffer = "#EXTM3U\n#EXT-X-VERSION:3\n"
+    buffer += f"#EXT-X-TARGETDURATION:{target}\n"
+    buffer += f"#EXT-X-MEDIA-SEQUENCE:{first_sequence}\n"
+    buffer += f"#EXT-X-DISCONTINUITY-SEQUENCE:{state['discontinuity_sequence']}\n"
+    for segment in segments:
+        if segment["discontinuity"]:
+            buffer += "#EXT-X-DISCONTINUITY\n"
+        buffer += f"#EXTINF:{segment['duration']:.6f},\n"
+        buffer += f"seg{segment['sequence']:06d}.{extension}\n"
+    return io.BytesIO(buffer.encode("utf-8"))
+
+def generate_hls_master():
+    buffer = "#EXTM3U\n"
+    buffer += '#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="Broadcast",' \
+              'LANGUAGE="en",DEFAULT=YES,AUTOSELECT=YES,URI="subtitles.m3u8"\n'
+    buffer += '#EXT-X-STREAM-INF:BANDWIDTH=140000,CODECS="mp4a.40.34",SUBTITLES="subs"\n'
+    buffer += "audio.m3u8\n"
+    return io.BytesIO(buffer.encode("utf-8"))
+
+def load_hls_state(bucket, key):
+    buffer = io.BytesIO()
+    try:
+        bucket.download_fileobj(key, buffer)
+    except ClientError as e:
+        logging.info(f"Can't read {key}, so starting a new playlist: {e}")
+        return {"next_sequence": 0, "discontinuity_sequence": 0, "segments": [], "expired": []}
+    return json.loads(buffer.getvalue())
+
+def publish_hls(bucket, config, filename, text_cues, work_dir):
+    # Uploads only the new segments (and their WebVTT counterparts), then
+    # rewrites the small playlists around them
+    prefix = config["hls_prefix"]
+    state = load_hls_state(bucket, prefix + "playlist.json")
+    old_segments = state["segments"]
+    new_segments = []
+    position = 0
+    for name, duration in segment_hls(filename, work_dir, config["hls_segment_secs"], state["next_sequence"]):
+        sequence = state["next_sequence"]
+        with open(os.path.join(work_dir, name), "rb") as f:
+            upload_file(bucket, prefix + name, f, ContentType="video/mp2t")
+        vtt_data = generate_vtt_segment(text_cues, position, position + duration)
+        upload_file(bucket, f"{prefix}seg{sequence:06d}.vtt", vtt_data, ContentType="text/vtt")
+        new_segments.append({
+            "sequence": sequence,
+            "duration": duration,
+            "discontinuity": not new_segments and bool(old_segments)
+        })
+        state["next_sequence"] += 1
+        position += duration
+
+    if not new_segments:
+        logging.warning("The stream produced no HLS segments")
+
+    total = sum(segment["duration"] for segment in old_segments + new_segments)
+    now = time.time()
+    expired = state.setdefault("expired", [])
+    aged_out = 0
+    while old_segments and total > config["hls_window_secs"]:
+        segment = old_segments.pop(0)
+        total -= segment["duration"]
+        if segment["discontinuity"]:
+            state["discontinuity_sequence"] += 1
+        expired.append({"sequence": segment["sequence"], "expired": now})
+        aged_out += 1
+    state["segments"] = old_segments + new_segments
+    logging.info(f"Added {len(new_segments)} segments to the playlist and aged out {aged_out}")
+
+    # Segments are deleted once no playlist a client might still have
+    # cached refers to them, which is usually on the next run
+    max_age = config["hls_playlist_max_age"]
+    deletable = [segment for segment in expired if segment["expired"] <= now - max_age]
+    state["expired"] = [segment for segment in expired if segment["expired"] > now - max_age]
+
+    playlist_args = {"ContentType": "application/vnd.apple.mpegurl", "CacheControl": f"max-age={max_age}"}
+    segment_secs = config["hls_segment_secs"]
+    upload_file(bucket, prefix + "audio.m3u8", generate_hls_playlist(state, "ts", segment_secs), **playlist_args)
+    upload_file(bucket, prefix + "subtitles.m3u8", generate_hls_playlist(state, "vtt", segment_secs), **playlist_args)
+    upload_file(bucket, prefix + "stream.m3u8", generate_hls_master(), **playlist_args)
+    upload_file(bucket, prefix + "playlist.json", io.BytesIO(json.dumps(state).encode("utf-8")))
+
+    if deletable and in_production():
+        logging.info(f"Deleting {len(deletable)} segments that aged out of earlier playlists")
+        keys = [f"{prefix}seg{segment['sequence']:06d}.{extension}"
+                for segment in deletable for extension in ("ts", "vtt")]
+        for i in range(0, len(keys), 1000):
+            bucket.delete_objects(Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]]})
+
+def assemble_segments(bucket, config, trims, files, stream, stream_secs):
+    audio_position = 0
+    text_cues = []
+    cache = get_segment_cache(config, bucket)
+    cache_hits = cache_misses = 0
+    logging.info(f"Generating up to {stream_secs * BYTES_PER_SEC} bytes of MP3 audio")
+    broadcasts = prefetch_broadcasts(bucket, config, cache, trims, files)
+    with closing(broadcasts):
+        for file, start, end, cache_key, trimmed_audio, audio in broadcasts:
+            if trimmed_audio is None:
+                logging.info(f"Truncating {file} from {start}s to {end}s")
+                trimmed_audio = trim_audio_stream(
+                    audio.getvalue(), start, end, config["fade_secs"], config["trim_mode"],
+                    config["stream_channels"])
+                cache.put(cache_key, trimmed_audio)
+                cache_misses += 1
+            else:
+                logging.info(f"Using cached segment of {file} from {start}s to {end}s")
+                cache_hits += 1
+            stream.write(trimmed_audio)
+            text_cues.append((audio_position, audio_position + end - start, get_broadcast_time(file)))
+            audio_position += end - start
+            if stream.size >= stream_secs * BYTES_PER_SEC:
+                break
+    logging.info(f"Segment cache: {cache_hits} hits, {cache_misses} misses")
+    cache.evict(config["segment_cache_max_bytes"])
+    return text_cues
+
+def assemble_graph(bucket, config, trims, files, stream, stream_secs):
+    audio_position = 0
+    text_cues = []
+    plan = []
+    logging.info(f"Planning {stream_secs}s of MP3 audio")
+    with tempfile.TemporaryDirectory() as work_dir:
+        broadcasts = prefetch_broadcasts(bucket, config, SegmentCache(), trims, files)
+        with closing(broadcasts):
+            for file, start, end, _, _, audio in broadcasts:
+                filename = os.path.join(work_dir, f"{len(plan):03d}.mp3")
+                with open(filename, "wb") as f:
+                    f.write(audio.getvalue())
+                plan.append((filename, start, end))
+                text_cues.append((audio_position, audio_position + end - start, get_broadcast_time(file)))
+                audio_position += end - start
+                if audio_position >= stream_secs:
+                    break
+        render_broadcasts(plan, config["fade_secs"], stream, config["stream_channels"])
+    return text_cues
+
+def timed_assemble(assemble, engine, bucket, config, trims, files, stream, stream_secs):
+    started = time.time()
+    text_cues = assemble(bucket, config, trims, files, stream, stream_secs)
+    elapsed = time.time() - started
+    audio_secs = text_cues[-1][1] if text_cues else 0
+    logging.info(f"Assembled {audio_secs}s of audio in {elapsed:.1f}s "
+                 f"({audio_secs / elapsed:.1f}x realtime) with the {engine} engine")
+    return text_cues
+
 def handle_event(event, context):
     set_log_level()
     config = get_config()
     bucket = get_bucket(config)
-    catalog = download_json(bucket, config["catalog"])
+    manifest = load_manifest(bucket, config)
+    trims = load_trims(bucket, config, manifest)
+    short = get_short_broadcasts(trims, config["min_broadcast_secs"])
+    logging.info(f"Skipping {len(short)} broadcasts shorter than {config['min_broadcast_secs']}s")
+    index = BroadcastIndex(load_catalog(bucket, config, manifest), short)
     stream_secs = int(event["length"]) if "length" in event else config["default_length"]
-    stream = io.BytesIO()
-    audio_position = 0
-    text_cues = []
-    file = get_last_file(catalog)
-    logging.info(f"Generating up to {stream_secs * BYTES_PER_SEC} bytes of MP3 audio")
-    while len(stream.getvalue()) < stream_secs * BYTES_PER_SEC:
-        cue_data = download_json(bucket, config["cue_prefix"] + file + ".json")
-        start, end = get_forecast_cues(cue_data)
-        logging.info(f"Truncating {file} from {start}s to {end}s")
-        audio = download_file(bucket, config["mp3_prefix"] + file)
-        trimmed_audio = trim_audio_stream(audio.getvalue(), start, end, config["fade_secs"])
-        stream.write(trimmed_audio)
-        text_cues.append((audio_position, audio_position + end - start, get_broadcast_time(file)))
-        audio_position += end - start
-        file = get_random_file(catalog)
-    stream.seek(0)
-    upload_file(bucket, config["stream_key"], stream)
-    vtt_data = generate_vtt_file(text_cues)
-    upload_file(bucket, config["stream_key"] + ".vtt", vtt_data)
+    seed = event.get("seed")
+    logging.info(f"Picking from {len(index.ids)} broadcasts with seed {seed}")
+    recent = load_recent(bucket, config["recent_key"])
+    picked = []
+    files = pick_files(index, random.Random(seed), chain.from_iterable(recent),
+                       config["timing_weights"], picked)
+    engine = event.get("engine", config["engine"])
+    assemble = assemble_graph if engine == "graph" else assemble_segments
+    if event.get("output", config["output"]) == "hls":
+        with tempfile.TemporaryDirectory() as work_dir:
+            filename = os.path.join(work_dir, "stream.mp3")
+            with LocalUpload(filename) as stream:
+                text_cues = timed_assemble(assemble, engine, bucket, config, trims, files, stream, stream_secs)
+            publish_hls(bucket, config, filename, text_cues, work_dir)
+    else:
+        stream = open_upload(bucket, config["stream_key"], config["upload_part_size"], "audio/mpeg")
+        with stream:
+            text_cues = timed_assemble(assemble, engine, bucket, config, trims, files, stream, stream_secs)
+        vtt_data = generate_vtt_file(text_cues)
+        upload_file(bucket, config["stream_key"] + ".vtt", vtt_data)
+    # Broadcasts that were prefetched but didn't make it into the stream
+    # don't count as played
+    recent = (recent + [picked[:len(text_cues)]])[-config["recent_runs"]:]
+    upload_file(bucket, config["recent_key"], io.BytesIO(json.dumps(recent).encode("utf-8")))
 
 if __name__ == "__main__":
     handle_event({}, {})
@@ -0,0 +1,43 @@
+"""Fixture audio for the benchmarks, synthesized with ffmpeg.
+
+Each fixture is a 128k mono MP3 like the archive's: quiet noise with tone
+bursts where a broadcast's cues would be, so the stub recognizer (and the
+trim points worked out from them) behave like they would on a real
+recording. Any MP3s in bench/samples/ are used as well, for benchmarking
+detection against real speech.
+"""
+import glob, os, subprocess
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+# name: (length, [tone burst start times])
+FIXTURES = {
+    "long": (12 * 60, [20, 95, 640, 700]),
+    "short": (6 * 60, [15, 70, 300, 345]),
+}
+
+def synthesize(filename, secs, tones, frequency=880):
+    bursts = "+".join(f"between(t,{t},{t + 1})" for t in tones) or "0"
+    expression = f"0.5*sin(2*PI*{frequency}*t)*({bursts})+0.01*(random(0)-0.5)"
+    subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-y',
+            '-f', 'lavfi', '-i', f"aevalsrc=exprs='{expression}':s=44100:d={secs}",
+            '-ac', '1', '-ab', '128k', '-f', 'mp3', filename],
+        check=True)
+
+def get_fixtures():
+    """Returns {name: (filename, length, tones)}, synthesizing any fixtures
+    that don't exist yet."""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    fixtures = {}
+    for name, (secs, tones) in FIXTURES.items():
+        filename = os.path.join(FIXTURE_DIR, f"{name}-{secs}s.mp3")
+        if not os.path.exists(filename):
+            synthesize(filename, secs, tones)
+        fixtures[name] = (filename, secs, tones)
+    return fixtures
+
+def get_samples():
+    """Returns the MP3s kept in bench/samples/, if any."""
+    return sorted(glob.glob(os.path.join(SAMPLE_DIR, "*.mp3")))
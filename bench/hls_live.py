@@ -0,0 +1,183 @@
+"""Records from a synthetic live HLS stream with download_hls, to check how
+the recorder copes with a sliding window, the rewind window and failures.
+
+    python3 hls_live.py [--secs=30] [--speed=4] [--window=6] [--backlog=0]
+                        [--start=secs] [--retry-segments=n,...]
+                        [--lose-segments=n,...] [--fail-polls=n,...]
+                        [--segments=mp3|ts]
+
+The server serves 2 s segments of a tone with
+EXT-X-PROGRAM-DATE-TIME, --speed times faster than real time, keeping the
+last --window of them in the playlist and starting with --backlog already
+there. --start records from that many seconds after the first segment's
+date, as a scheduled start does (negative is before the rewind window).
+Segments in --retry-segments fail once with a 503, which the recorder's
+retries should absorb; those in --lose-segments always fail; playlist polls
+in --fail-polls (counted from 1) fail with a 404. The segments are packed
+MP3 audio by default; --segments=ts makes MPEG-TS with AAC like the BBC's
+streams.
+
+It prints the recorder's timeline and checks the recording decodes to about
+the length recorded, exiting with an error if not.
+"""
+import http.server, json, logging, os, re, subprocess, sys, tempfile, threading, time
+from datetime import datetime, timedelta, timezone
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(bench_dir), "download"))
+
+import download_forecast
+
+SEGMENT_SECS = 2
+
+def make_segments(work_dir, count, extension="mp3"):
+    # Returns the durations of count segments of a tone in work_dir
+    playlist = os.path.join(work_dir, 'vod.m3u8')
+    if extension == "ts":
+        output = ['-c:a', 'aac', '-f', 'hls', '-hls_time', str(SEGMENT_SECS), '-hls_list_size', '0',
+                  '-hls_segment_filename', os.path.join(work_dir, 'seg%d.ts'), playlist]
+    else:
+        # Packed audio: bare MP3 frames, with no header to repeat mid-stream
+        output = ['-c:a', 'libmp3lame', '-f', 'segment',
+                  '-segment_format_options', 'id3v2_version=0:write_xing=0',
+                  '-segment_time', str(SEGMENT_SECS), '-segment_list', playlist,
+                  os.path.join(work_dir, 'seg%d.mp3')]
+    subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi',
+            '-i', f"sine=f=440:d={count * SEGMENT_SECS}", '-ac', '1', *output],
+        check=True)
+    with open(os.path.join(work_dir, 'vod.m3u8')) as f:
+        return [float(d) for d in re.findall(r"#EXTINF:([\d.]+)", f.read())]
+
+class LiveStream:
+    # A live stream over the segments: segment n is published at n *
+    # SEGMENT_SECS / speed seconds after the server starts, less the backlog
+
+    def __init__(self, work_dir, durations, extension, speed, window, backlog, retry=(), lose=(), fail_polls=()):
+        self.work_dir, self.durations, self.extension = work_dir, durations, extension
+        self.speed, self.window, self.backlog = speed, window, backlog
+        self.retry, self.lose, self.fail_polls = set(retry), set(lose), set(fail_polls)
+        self.retried = set()
+        self.polls = 0
+        self.started = time.time()
+        # The dates run in real time, as a broadcaster's would
+        self.date0 = datetime.now(timezone.utc) - timedelta(seconds=backlog * SEGMENT_SECS)
+
+    def date(self, n):
+        return self.date0 + timedelta(seconds=sum(self.durations[:n]))
+
+    def playlist(self):
+        available = min(len(self.durations),
+                        self.backlog + int((time.time() - self.started) * self.speed / SEGMENT_SECS))
+        first = max(0, available - self.window)
+        body = "#EXTM3U\n#EXT-X-VERSION:3\n"
+        body += f"#EXT-X-TARGETDURATION:{SEGMENT_SECS / self.speed}\n#EXT-X-MEDIA-SEQUENCE:{first}\n"
+        for n in range(first, available):
+            date = self.date(n).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+            body += f"#EXT-X-PROGRAM-DATE-TIME:{date}\n#EXTINF:{self.durations[n]},\nseg{n}.{self.extension}\n"
+        if available == len(self.durations):
+            body += "#EXT-X-ENDLIST\n"
+        return body
+
+    def handler(self):
+        stream = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=b""):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/master.m3u8":
+                    return self.reply(200, b"#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=96000\nlive.m3u8\n")
+                if self.path == "/live.m3u8":
+                    stream.polls += 1
+                    if stream.polls in stream.fail_polls:
+                        return self.reply(404)
+                    return self.reply(200, stream.playlist().encode())
+                m = re.fullmatch(rf"/seg(\d+)\.{stream.extension}", self.path)
+                if not m:
+                    return self.reply(404)
+                n = int(m.group(1))
+                if n in stream.lose or (n in stream.retry and n not in stream.retried):
+                    stream.retried.add(n)
+                    return self.reply(404 if n in stream.lose else 503)
+                with open(os.path.join(stream.work_dir, f"seg{n}.{stream.extension}"), "rb") as f:
+                    return self.reply(200, f.read())
+        return Handler
+
+class Recording:
+    # Stands in for UploadQueue's upload, keeping the MP3 in memory
+    def __init__(self):
+        self.data = bytearray()
+        self.size = 0
+
+    def write(self, data):
+        self.data += data
+        self.size += len(data)
+        return len(data)
+
+def get_duration(data):
+    output = subprocess.run(['ffmpeg', '-i', '-', '-f', 'null', '-'],
+                            input=bytes(data), capture_output=True).stderr.decode()
+    times = re.findall(r"time=(\d+):(\d+):([\d.]+)", output)
+    h, m, s = times[-1] if times else (0, 0, 0)
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+def get_options(argv):
+    options = {"secs": 30.0, "speed": 4.0, "window": 6, "backlog": 0, "start": None,
+               "retry_segments": "", "lose_segments": "", "fail_polls": "", "segments": "mp3"}
+    for arg in argv:
+        name, _, value = arg.lstrip("-").partition("=")
+        name = name.replace("-", "_")
+        if name not in options:
+            sys.exit(__doc__)
+        if name == "start":
+            options[name] = float(value)
+        elif isinstance(options[name], (int, float)):
+            options[name] = type(options[name])(value)
+        else:
+            options[name] = value
+    for name in ("retry_segments", "lose_segments", "fail_polls"):
+        options[name] = [int(n) for n in options[name].split(",") if n]
+    return options
+
+def main(argv):
+    options = get_options(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Enough for the recording plus the backlog and some to spare
+        count = options["backlog"] + int(options["secs"] / SEGMENT_SECS) + options["window"] + 10
+        durations = make_segments(work_dir, count, options["segments"])
+        stream = LiveStream(work_dir, durations, options["segments"], options["speed"],
+                            options["window"], options["backlog"], options["retry_segments"],
+                            options["lose_segments"], options["fail_polls"])
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), stream.handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/master.m3u8"
+
+        start = None
+        if options["start"] is not None:
+            start = stream.date0 + timedelta(seconds=options["start"])
+        recording = download_forecast.UploadQueue(Recording())
+        started = time.time()
+        timeline = download_forecast.download_hls(url, recording, options["secs"], start=start)
+        elapsed = time.time() - started
+        server.shutdown()
+
+    recorded = sum(segment["duration"] for segment in timeline["segments"])
+    duration = get_duration(recording.upload.data)
+    print(json.dumps({**timeline, "segments": len(timeline["segments"])}, indent=2))
+    print(f"recorded {recorded:.1f} s of segments in {elapsed:.1f} s, "
+          f"{duration:.1f} s of MP3 in {recording.upload.size} bytes, "
+          f"{timeline['lost_secs']:.1f} s lost in {len(timeline['gaps'])} gaps, {stream.polls} polls")
+    if not timeline["segments"] or abs(duration - recorded) > SEGMENT_SECS:
+        sys.exit("the recording doesn't match the segments recorded")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
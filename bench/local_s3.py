@@ -0,0 +1,136 @@
+"""An in-memory stand-in for the parts of a boto3 S3 Bucket resource that
+the Lambdas use, with an optional delay per request to model S3's latency.
+Conditional puts behave like S3's, so catalog updates retry as they would.
+"""
+import hashlib, io, threading, time, types
+import botocore.session
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+def not_found(operation):
+    return ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, operation)
+
+class LocalObject:
+    def __init__(self, bucket, key):
+        self.bucket, self.key = bucket, key
+
+    @property
+    def e_tag(self):
+        return self.bucket.stat(self.key)["ETag"]
+
+    def get(self):
+        data, etag = self.bucket.read(self.key, "GetObject")
+        return {"Body": io.BytesIO(data), "ETag": etag}
+
+    def put(self, Body=b"", IfMatch=None, IfNoneMatch=None, **extra_args):
+        self.bucket.write(self.key, Body, IfMatch, IfNoneMatch)
+        return {}
+
+    def download_fileobj(self, buffer):
+        self.bucket.download_fileobj(self.key, buffer)
+
+class LocalObjects:
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def filter(self, Prefix=""):
+        return [LocalSummary(key, len(data), modified)
+                for key, (data, _, modified) in sorted(self.bucket.store.items())
+                if key.startswith(Prefix)]
+
+class LocalSummary:
+    def __init__(self, key, size, last_modified):
+        self.key, self.size, self.last_modified = key, size, last_modified
+
+class LocalClient:
+    """Stands in for the bucket's boto3 client, for the few calls made
+    through it."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        # The real model, for code that checks which parameters S3 takes
+        self.meta = types.SimpleNamespace(
+            service_model=botocore.session.get_session().get_service_model("s3"))
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        self.bucket.download_fileobj(Key, Fileobj)
+
+    def head_object(self, Bucket, Key):
+        return self.bucket.stat(Key)
+
+    def copy_object(self, Bucket, Key, CopySource, **extra_args):
+        data, _ = self.bucket.read(CopySource["Key"], "CopyObject")
+        self.bucket.write(Key, data)
+
+class LocalBucket:
+    """Args:
+        latency: Seconds to wait before every request.
+    """
+
+    def __init__(self, name="bench", latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.store = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.objects = LocalObjects(self)
+        self.meta = types.SimpleNamespace(client=LocalClient(self))
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def read(self, key, operation):
+        self.request()
+        with self.lock:
+            if key not in self.store:
+                raise not_found(operation)
+            data, etag, _ = self.store[key]
+        return data, etag
+
+    def stat(self, key):
+        data, etag = self.read(key, "HeadObject")
+        return {"ETag": etag, "ContentLength": len(data)}
+
+    def write(self, key, body, if_match=None, if_none_match=None):
+        self.request()
+        data = body if isinstance(body, bytes) else body.read()
+        with self.lock:
+            current = self.store.get(key)
+            if (if_match and (not current or current[1] != if_match)) or \
+                    (if_none_match == "*" and current):
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            self.store[key] = (data, etag, datetime.now(timezone.utc))
+
+    def put(self, key, data):
+        # For setting up fixtures, without counting as a request
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.store[key] = (data, etag, datetime.now(timezone.utc))
+
+    def Object(self, key):
+        return LocalObject(self, key)
+
+    def download_fileobj(self, key, buffer):
+        data, _ = self.read(key, "GetObject")
+        buffer.write(data)
+
+    def upload_fileobj(self, fileobj, key, ExtraArgs=None):
+        self.write(key, fileobj)
+
+    def delete_objects(self, Delete):
+        self.request()
+        with self.lock:
+            for obj in Delete["Objects"]:
+                self.store.pop(obj["Key"], None)
+
+class LocalS3:
+    """Stands in for boto3.resource('s3')."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def Bucket(self, name):
+        return self.bucket
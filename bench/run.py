@@ -0,0 +1,270 @@
+"""Benchmarks the pipeline's hot paths offline.
+
+    python3 run.py [--only=name,...] [--repeat=N] [--model=path]
+                   [--s3-latency=secs] [--output=path]
+                   [--baseline=path] [--threshold=fraction]
+
+Runs each benchmark --repeat times (3 by default) and writes the median
+and every run's time to a JSON file in bench/results/, or --output. With
+--baseline, each benchmark is compared with the same one in an earlier
+results file, and it exits with an error if any is more than --threshold
+(0.2 by default) slower.
+
+detect uses the Vosk model at --model (tools/detection/model by default)
+if there is one, and otherwise a stub recognizer that hears a trigger word
+at each tone burst, which still measures decoding and everything around
+recognition. Results from the two aren't compared with each other.
+"""
+import array, io, json, logging, os, platform, subprocess, sys, tempfile, time, types
+from datetime import datetime
+from unittest import mock
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(bench_dir)
+for path in ("transcribe", "assemble", "catalog"):
+    sys.path.insert(0, os.path.join(root, path))
+
+import transcribe_forecast, assemble_stream, catalog_forecast
+from fixtures import get_fixtures, get_samples
+from local_s3 import LocalBucket, LocalS3
+
+RESULT_DIR = os.path.join(bench_dir, "results")
+DEFAULT_MODEL = os.path.join(root, "tools", "detection", "model")
+
+class StubRecognizer:
+    # Hears "shipping" at the start of every tone burst and completes a
+    # line at its end, at a fraction of the cost of a real recognizer
+
+    def __init__(self):
+        self.loud = False
+        self.partial = '{"partial": ""}'
+
+    def Reset(self):
+        self.loud = False
+
+    def AcceptWaveform(self, data):
+        samples = array.array("h", data)
+        loud = max(map(abs, samples)) > 8000 if samples else False
+        started, ended = loud and not self.loud, self.loud and not loud
+        self.loud = loud
+        self.partial = '{"partial": "shipping"}' if started else '{"partial": ""}'
+        return ended
+
+    def Result(self):
+        return '{"text": "shipping forecast"}'
+
+    def PartialResult(self):
+        return self.partial
+
+def get_recognizer(model_path):
+    if model_path and os.path.exists(model_path):
+        model = transcribe_forecast.get_model(model_path)
+        return "vosk", lambda: transcribe_forecast.recognizer(model)
+    return "stub", StubRecognizer
+
+class Sink:
+    # Counts what assembly writes instead of keeping it
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+def cue_data(secs, tones):
+    # Cue data like transcribe_forecast's for a fixture, with the tones as
+    # the opening and closing cues
+    return {"cues": {"shipping": [tones[0], tones[-2]], "forecast": [tones[1]],
+                     "bbc": [tones[-1]]}, "length": secs}
+
+def bench_detect(fixtures, new_recognizer):
+    def detect(filename, windows=None):
+        return lambda: transcribe_forecast.detect(new_recognizer(), filename, windows)
+    benchmarks = {}
+    for name, (filename, secs, _) in fixtures.items():
+        benchmarks[f"detect/{name}"] = (detect(filename), secs)
+    filename, secs, _ = fixtures["long"]
+    windows = transcribe_forecast.get_config()["cue_windows"]
+    benchmarks["detect_windows/long"] = (detect(filename, windows), secs)
+    for filename in get_samples():
+        secs = transcribe_forecast.get_duration(filename)
+        benchmarks[f"detect/sample/{os.path.basename(filename)}"] = (detect(filename), secs)
+    return benchmarks
+
+def bench_trim(fixtures):
+    filename, secs, tones = fixtures["long"]
+    with open(filename, "rb") as f:
+        data = f.read()
+    start, end = assemble_stream.get_forecast_cues(cue_data(secs, tones))
+    return {
+        f"trim_{mode}/long": (lambda mode=mode: assemble_stream.trim_audio_stream(data, start, end, 5, mode), end - start)
+        for mode in ("copy", "encode")
+    }
+
+def make_archive(fixtures, count):
+    # A bucket of count broadcasts made from the fixtures, with their trims
+    bucket = LocalBucket()
+    trims = {}
+    files = []
+    for i in range(count):
+        timing = ("0048", "0520", "1201", "1754")[i % 4]
+        filename, secs, tones = fixtures["long" if timing in ("0048", "0520") else "short"]
+        broadcast = f"2024{1 + i // 112:02d}{1 + i // 4 % 28:02d}Z{timing}"
+        with open(filename, "rb") as f:
+            bucket.put(f"archive/{broadcast}.mp3", f.read())
+        trims[broadcast] = catalog_forecast.get_trim(cue_data(secs, tones))
+        files.append(broadcast + ".mp3")
+    return bucket, trims, files
+
+def bench_assemble(fixtures, stream_secs=30 * 60):
+    bucket, trims, files = make_archive(fixtures, 8)
+
+    def assemble(engine):
+        def run():
+            with tempfile.TemporaryDirectory() as cache_dir:
+                config = dict(assemble_stream.get_config(), segment_cache_dir=cache_dir)
+                assemble = assemble_stream.assemble_graph if engine == "graph" else assemble_stream.assemble_segments
+                assemble(bucket, config, trims, iter(files * 4), Sink(), stream_secs)
+        return run
+    return {f"assemble_{engine}": (assemble(engine), stream_secs) for engine in ("segments", "graph")}
+
+def bench_forecast_cues(fixtures, calls=10000):
+    data = cue_data(*fixtures["long"][1:])
+    def run():
+        for _ in range(calls):
+            assemble_stream.get_forecast_cues(data)
+    return {f"get_forecast_cues/{calls}": (run, None)}
+
+def bench_catalog(fixtures, latency, years=4):
+    # A catalog of several years of broadcasts, to which each run adds a
+    # day's worth of new ones
+    bucket = LocalBucket(latency=latency)
+    config = catalog_forecast.get_config()
+    shards = {}
+    for year in range(2020, 2020 + years):
+        for month in range(1, 13):
+            for day in range(1, 29):
+                for timing in config["broadcast_times"]:
+                    catalog_forecast.add_broadcast(shards.setdefault(str(year), {}), f"{month:02d}", f"{day:02d}", timing)
+    for year, shard in shards.items():
+        bucket.put(catalog_forecast.shard_key(config, year), json.dumps(shard).encode())
+    manifest = catalog_forecast.update_manifest(config, {}, shards)
+    bucket.put(config["catalog_prefix"] + "manifest.json", json.dumps(manifest).encode())
+    bucket.put(config["catalog"], json.dumps(shards).encode())
+
+    _, secs, tones = fixtures["long"]
+    days = iter(range(1, 10000))
+    # Only while the benchmark runs, so nothing else sees production mode
+    patches = mock.patch.multiple(
+        catalog_forecast, boto3=types.SimpleNamespace(resource=lambda *args: LocalS3(bucket)),
+        in_production=lambda: True, set_log_level=lambda: None)
+
+    def run():
+        day = next(days)
+        entries = [{"file": f"archive/2030{1 + day // 28 % 12:02d}{1 + day % 28:02d}Z{timing}.mp3",
+                    **cue_data(secs, tones)} for timing in config["broadcast_times"]]
+        with patches:
+            catalog_forecast.handle_event({"files": entries}, {})
+    return {"catalog_update": (run, None)}, bucket
+
+def measure(run, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    return sorted(times)[len(times) // 2], times
+
+def get_environment(recognizer):
+    def output(args):
+        try:
+            return subprocess.run(args, capture_output=True, text=True, cwd=root).stdout.splitlines()[0]
+        except (OSError, IndexError):
+            return None
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": output(["git", "rev-parse", "--short", "HEAD"]),
+        "python": platform.python_version(),
+        "ffmpeg": output(["ffmpeg", "-version"]),
+        "cpus": os.cpu_count(),
+        "recognizer": recognizer,
+    }
+
+def compare(results, baseline, threshold):
+    # Returns the benchmarks that are more than threshold slower than in
+    # baseline, printing how each one changed
+    regressions = []
+    if baseline["environment"]["recognizer"] != results["environment"]["recognizer"]:
+        print(f"Baseline used the {baseline['environment']['recognizer']} recognizer, so not comparing detect")
+    for name, result in results["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if not before or (name.startswith("detect") and
+                          baseline["environment"]["recognizer"] != results["environment"]["recognizer"]):
+            continue
+        change = result["secs"] / before["secs"] - 1
+        slower = change > threshold
+        print(f"{name:32} {before['secs']:9.4f}s -> {result['secs']:9.4f}s {change:+7.1%}"
+              + ("  REGRESSION" if slower else ""))
+        if slower:
+            regressions.append(name)
+    return regressions
+
+def get_options(argv):
+    options = {"repeat": 3, "model": DEFAULT_MODEL, "s3_latency": 0.01, "threshold": 0.2,
+               "only": None, "output": None, "baseline": None}
+    for arg in argv:
+        name, _, value = arg.lstrip("-").partition("=")
+        name = name.replace("-", "_")
+        if name not in options:
+            sys.exit(__doc__)
+        options[name] = type(options[name])(value) if isinstance(options[name], (int, float)) else value
+    if options["only"]:
+        options["only"] = options["only"].split(",")
+    return options
+
+def main(argv):
+    options = get_options(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    fixtures = get_fixtures()
+    recognizer, new_recognizer = get_recognizer(options["model"])
+
+    benchmarks = {}
+    benchmarks.update(bench_detect(fixtures, new_recognizer))
+    benchmarks.update(bench_trim(fixtures))
+    benchmarks.update(bench_assemble(fixtures))
+    benchmarks.update(bench_forecast_cues(fixtures))
+    catalog, bucket = bench_catalog(fixtures, options["s3_latency"])
+    benchmarks.update(catalog)
+
+    results = {"environment": get_environment(recognizer), "benchmarks": {}}
+    for name, (run, audio_secs) in benchmarks.items():
+        if options["only"] and not any(name.startswith(only) for only in options["only"]):
+            continue
+        requests = bucket.requests
+        secs, times = measure(run, options["repeat"])
+        result = {"secs": round(secs, 6), "runs": [round(t, 6) for t in times]}
+        if audio_secs:
+            result["x_realtime"] = round(audio_secs / secs, 2)
+        if name == "catalog_update":
+            result["s3_requests"] = (bucket.requests - requests) // options["repeat"]
+            result["s3_latency"] = options["s3_latency"]
+        results["benchmarks"][name] = result
+        print(f"{name:32} {secs:9.4f}s" + (f" {result['x_realtime']:8.1f}x realtime" if audio_secs else ""))
+
+    output = options["output"] or os.path.join(
+        RESULT_DIR, datetime.now().strftime("%Y%m%dT%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    if options["baseline"]:
+        with open(options["baseline"]) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options["threshold"])
+        if regressions:
+            sys.exit(f"{len(regressions)} benchmarks regressed by more than {options['threshold']:.0%}: "
+                     + ", ".join(regressions))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
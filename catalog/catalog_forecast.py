@@ -1,12 +1,20 @@
-import os, logging, io, json, re
-import boto3
+import os, logging, io, json, re, time, random
+import boto3, botocore
 from botocore.exceptions import ClientError
 
 def get_config():
     return {
         "bucket": "gale8-uk",
         "cue_prefix": "cues/",
+        # the old single-file catalog, still written for compatibility
         "catalog": "archive/catalog.json",
+        # per-year shards like archive/catalog/2024.json, listed in manifest.json
+        "catalog_prefix": "archive/catalog/",
+        "write_legacy_catalog": True,
+        # Trims (broadcast ID -> [length, trim start, trim end]) go in
+        # per-year shards like archive/catalog/2024.trims.json listed in the
+        # manifest, so assemble doesn't need every broadcast's full cue file.
+        # tools/build-catalog.py backfills the shards for older years.
         "broadcast_times": ["0048", "0520", "1201", "1754"]
     }
 
@@ -29,55 +37,237 @@ def download_json(bucket, key):
         logging.info(f"Can't find {key}: {e}")
     return data
 
-def upload_json(bucket, key, data):
-    logging.info(f"Uploading {key} to {bucket.name}")
-    buffer = io.BytesIO(json.dumps(data).encode("utf-8"))
-    if not in_production():
-        logging.info("(not running in production, so not actually uploading)")
-        return
-    bucket.upload_fileobj(buffer, key, ExtraArgs={"ACL": "public-read"})
+def read_json(bucket, key):
+    # Returns the object's data along with its ETag, or (None, None)
+    logging.info(f"Downloading {key} from {bucket.name}")
+    try:
+        response = bucket.Object(key).get()
+    except ClientError as e:
+        logging.info(f"Can't find {key}: {e}")
+        return None, None
+    return json.load(response["Body"]), response["ETag"]
 
-def handle_event(event, context):
-    set_log_level()
+def check_conditional_writes(bucket):
+    # Conditional puts need a newer botocore than some Lambda runtimes
+    # bundle, which would reject IfMatch before sending anything. The zip
+    # ships a pinned boto3 (see requirements.txt), so this only fails if
+    # that's missing.
+    members = bucket.meta.client.meta.service_model.operation_model("PutObject").input_shape.members
+    if "IfMatch" not in members or "IfNoneMatch" not in members:
+        raise Exception(f"botocore {botocore.__version__} doesn't support conditional writes to S3; "
+                        "deploy with the boto3 in requirements.txt")
 
-    config = get_config()
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(config["bucket"])
+def update_json(bucket, key, update, attempts=8):
+    # Read-modify-write of a JSON object that only succeeds if nobody else
+    # wrote the object in between; otherwise it re-reads and tries again.
+    # update() returns the new data, or None to leave the object alone.
+    for attempt in range(attempts):
+        data, etag = read_json(bucket, key)
+        data = update(data)
+        if data is None:
+            return None
+        logging.info(f"Uploading {key} to {bucket.name}")
+        if not in_production():
+            logging.info("(not running in production, so not actually uploading)")
+            return data
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            bucket.Object(key).put(
+                Body=json.dumps(data).encode("utf-8"),
+                ACL="public-read",
+                ContentType="application/json",
+                **condition)
+            return data
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            logging.info(f"{key} changed while updating it; retrying")
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise Exception(f"Gave up updating {key} after {attempts} attempts")
+
+def add_broadcast(catalog, month, day, timing):
+    timings = catalog.setdefault(month, {}).setdefault(day, [])
+    if timing in timings:
+        return False
+    timings.append(timing)
+    timings.sort()
+    return True
+
+def merge_catalog(catalog, additions):
+    # Adds every broadcast in additions (a year's {month: {day: [timing]}})
+    # to catalog, returning how many weren't already there
+    added = 0
+    for month, days in additions.items():
+        for day, timings in days.items():
+            for timing in timings:
+                added += add_broadcast(catalog, month, day, timing)
+    return added
+
+def shard_key(config, year):
+    return f"{config['catalog_prefix']}{year}.json"
+
+def trims_key(config, year):
+    return f"{config['catalog_prefix']}{year}.trims.json"
+
+def count_broadcasts(shard):
+    return sum(len(timings) for days in shard.values() for timings in days.values())
+
+def latest_broadcast(year, shard):
+    month = max(shard)
+    day = max(shard[month])
+    return f"{year}{month}{day}Z{max(shard[month][day])}"
+
+def update_manifest(config, manifest, shards, trims_years=()):
+    # Shards only ever grow, so a count lower than the manifest's must be
+    # from a write that has since been overtaken
+    entries = manifest.setdefault("shards", {})
+    for year, shard in shards.items():
+        count = max(count_broadcasts(shard), entries.get(year, {}).get("count", 0))
+        entries[year] = {**entries.get(year, {}), "key": shard_key(config, year), "count": count}
+        manifest["latest"] = max(manifest.get("latest", ""), latest_broadcast(year, shard))
+    for year in trims_years:
+        if year in entries:
+            entries[year]["trims"] = trims_key(config, year)
+    manifest["count"] = sum(entry["count"] for entry in entries.values())
+    return manifest
 
-    file = event["file"]
+def get_forecast_cues(data, spacing_secs=5):
+    # Same as in assemble_stream, which used to work this out per broadcast
+    duration = data["length"]
+    start_boundary = (2.5 if duration > 5*60 else 1.5) * 60
+    end_boundary = (5 if duration > 9*60 else 3) * 60
+    cues = data["cues"]
+    start = 0
+    if "shipping" in cues:
+        times = list(
+            sorted(t for t in cues["shipping"] if t <= start_boundary))
+        if times:
+            start = times[-1]
+    if not start and "forecast" in cues:
+        times = list(
+            sorted(t for t in cues["forecast"] if t <= start_boundary))
+        if times:
+            start = times[0]
+    if start > spacing_secs:
+        start -= spacing_secs
+    end = duration
+    for key in ("shipping", "bulletin", "bbc", "radio"):
+        if key not in cues:
+            continue
+        times = list(sorted(t for t in cues[key] if t >= end_boundary))
+        if times:
+            end = times[0]
+        if end:
+            break
+    if end + spacing_secs < duration:
+        end += spacing_secs
+    return (start, end)
+
+def get_trim(data):
+    start, end = get_forecast_cues(data)
+    return [data["length"], start, end]
+
+def parse_broadcast(config, bucket, entry):
+    # Returns (year, month, day, timing, trim) for an event entry, which is
+    # either an MP3 key or {"file": key, "cues": {...}, "length": secs}, or
+    # None if it can't be cataloged. trim is None if there's no length.
+    if isinstance(entry, str):
+        entry = {"file": entry}
+    file = entry["file"]
     logging.info(f"Attempting to catalog {file}")
 
-    if "cues" not in event:
+    if "cues" not in entry or "length" not in entry:
         cue_file = config["cue_prefix"] + os.path.basename(file) + ".json"
-        cues = download_json(bucket, cue_file)
-    else:
-        cues = event["cues"]
-
-    catalog = download_json(bucket, config["catalog"])
-    if not catalog:
-        logging.error(f"Can't read catalog file {catalog}")
-        return
+        cue_data = download_json(bucket, cue_file) or {}
+        entry = {"cues": cue_data.get("cues"), "length": cue_data.get("length"), **entry}
+    cues = entry["cues"]
 
     if cues and "shipping" not in cues and "forecast" not in cues:
-        logging.info(f"Can't identify start time of broadcast from cues; skipping catalog")
-        return
+        logging.info(f"Can't identify start time of {file} from cues; skipping catalog")
+        return None
 
     m = re.match(r'.*\b(....)(..)(..)Z(....).mp3$', file)
     if not m:
         logging.error(f"File {file} doesn't match naming format")
-        return
+        return None
 
     year, month, day, timing = m.groups()
     if timing not in config["broadcast_times"]:
         logging.info(f"Start time {timing} doesn't match a broadcast time; skipping catalog")
+        return None
+    trim = get_trim(entry) if cues is not None and entry["length"] is not None else None
+    return year, month, day, timing, trim
+
+def handle_event(event, context):
+    set_log_level()
+
+    config = get_config()
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(config["bucket"])
+    check_conditional_writes(bucket)
+
+    # {"file": key, "cues": {...}, "length": secs} catalogs one file; {"files": [...]}
+    # catalogs a batch with one write per shard
+    entries = event.get("files") or [{k: v for k, v in event.items() if k in ("file", "cues", "length") and v is not None}]
+    additions = {}
+    trims = {}
+    for entry in entries:
+        broadcast = parse_broadcast(config, bucket, entry)
+        if broadcast:
+            year, month, day, timing, trim = broadcast
+            add_broadcast(additions.setdefault(year, {}), month, day, timing)
+            if trim:
+                trims.setdefault(year, {})[f"{year}{month}{day}Z{timing}"] = trim
+    if not additions:
         return
 
-    catalog.setdefault(year, {}) \
-           .setdefault(month, {}) \
-           .setdefault(day, []) \
-           .append(timing)
+    # Trims can change when a broadcast is transcribed again, so they're
+    # updated even if the broadcast is already cataloged. Only the years
+    # with new trims are rewritten.
+    for year, year_trims in trims.items():
+        def update_trims(index):
+            index = index or {}
+            changed = {id: trim for id, trim in year_trims.items() if index.get(id) != trim}
+            index.update(changed)
+            return index if changed else None
+        update_json(bucket, trims_key(config, year), update_trims)
+
+    manifest_key = config["catalog_prefix"] + "manifest.json"
+    manifest, _ = read_json(bucket, manifest_key)
+    if not manifest:
+        catalog, _ = read_json(bucket, config["catalog"])
+        if not catalog:
+            logging.error(f"Can't read catalog file {config['catalog']}")
+            return
+        logging.info("No catalog manifest yet, so splitting the catalog into shards")
+        for year, shard in catalog.items():
+            merge_catalog(additions.setdefault(year, {}), shard)
+
+    shards = {}
+    for year, added in additions.items():
+        def update_shard(shard):
+            shard = shard or {}
+            return shard if merge_catalog(shard, added) else None
+        shard = update_json(bucket, shard_key(config, year), update_shard)
+        if shard:
+            shards[year] = shard
+    listed = (manifest or {}).get("shards", {})
+    unlisted_trims = [year for year in trims if "trims" not in listed.get(year, {})]
+    if shards or unlisted_trims:
+        update_json(bucket, manifest_key,
+            lambda manifest: update_manifest(config, manifest or {}, shards, trims))
+    if not shards:
+        logging.info("All broadcasts were already cataloged")
+        return
 
-    upload_json(bucket, config["catalog"], catalog)
+    if config["write_legacy_catalog"]:
+        def update_catalog(catalog):
+            if catalog is None:
+                return None
+            added = sum(merge_catalog(catalog.setdefault(year, {}), shard) for year, shard in additions.items())
+            return catalog if added else None
+        update_json(bucket, config["catalog"], update_catalog)
+    logging.info(f"Cataloged {len(entries)} files, updating {len(shards)} shards")
 
 if __name__ == "__main__":
     import sys
@@ -1,13 +1,19 @@
 import time
 import os
+import re
 import os.path
 import logging
-import tempfile
 import json
 import subprocess
 import traceback
+import threading
+import queue
 import boto3
 import pytz
+import urllib3
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime, timedelta
 
 london = pytz.timezone('Europe/London')
@@ -24,7 +30,23 @@ def get_config():
         "stream": os.environ["FORECAST_STREAM"],
         "notify": os.environ["ERROR_TOPIC_ARN"],
         "bucket": "gale8-uk",
-        "prefix": "archive/"
+        "prefix": "archive/",
+        # recognize cues while recording, so the recording can be cataloged
+        # as soon as it's uploaded rather than transcribed afterwards
+        "live_cues": False,
+        # the recording is uploaded in parts of this size as it's recorded
+        "upload_part_size": 8 << 20,
+        # "ffmpeg" records with ffmpeg, restarting it whenever it exits;
+        # "hls" fetches the stream's HLS segments itself (see download_hls)
+        "recorder": "ffmpeg",
+        # ffmpeg is restarted if its output and progress stop for this long
+        "stall_secs": 10,
+        "hls_workers": 4,
+        # where in a live playlist to start, counting back from the newest
+        # segment like ffmpeg's live_start_index
+        "hls_live_start_index": -3,
+        "cue_prefix": "cues/",
+        "model": "/opt/model"
     }
 
 def set_log_level():
@@ -49,7 +71,225 @@ def notify(msg):
         Message=traceback.format_exc()
     )
 
-def download_stream_segment(stream, target):
+class PipeQueue:
+    # Drains what ffmpeg writes to a pipe into a queue in the background,
+    # one segment's pipe at a time, so whatever consumes the queue falling
+    # behind never holds up the recording. None on the queue marks the end.
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.reader = None
+        # bytes and first/last write times for each pipe, for the timeline
+        self.pipes = []
+
+    def open_pipe(self):
+        # Returns the fd for ffmpeg to write to, after the last segment's
+        # output has all been read
+        if self.reader:
+            self.reader.join()
+        read_fd, write_fd = os.pipe()
+        self.pipes.append({"bytes": 0, "first": None, "last": None})
+        self.reader = threading.Thread(target=self.read, args=(read_fd, self.pipes[-1]), daemon=True)
+        self.reader.start()
+        return write_fd
+
+    def read(self, fd, stats):
+        with os.fdopen(fd, "rb", buffering=0) as pipe:
+            for data in iter(lambda: pipe.read(1 << 16), b""):
+                stats["last"] = time.time()
+                stats["first"] = stats["first"] or stats["last"]
+                stats["bytes"] += len(data)
+                self.queue.put(data)
+
+    def close(self):
+        if self.reader:
+            self.reader.join()
+        self.queue.put(None)
+
+class MultipartUpload:
+    # File-like sink that sends what's written to it to S3 as the parts of a
+    # multipart upload, so at most one part is ever held in memory
+
+    def __init__(self, bucket, key, part_size, **extra_args):
+        self.client = boto3.client('s3')
+        self.bucket, self.key, self.part_size = bucket, key, part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        response = self.client.create_multipart_upload(
+            Bucket=bucket, Key=key, **extra_args)
+        self.upload_id = response["UploadId"]
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(self.part_size)
+        return len(data)
+
+    def upload_part(self, length):
+        body = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        logging.info(f"uploaded part {part_number} of {self.key}")
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self.upload_part(len(self.buffer))
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            logging.error(f"aborting upload of {self.key}: {exc}")
+            self.abort()
+
+class LocalUpload:
+    # Stands in for MultipartUpload when not running in production
+
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+
+def open_upload(bucket, key, part_size):
+    logging.info(f"uploading to s3://{bucket}/{key} while recording")
+    if in_production():
+        return MultipartUpload(bucket, key, part_size,
+                               ACL='public-read', ContentType='audio/mpeg')
+    logging.info(f"(not running in production; saving to {os.path.basename(key)} instead)")
+    return LocalUpload(os.path.basename(key))
+
+class UploadQueue(PipeQueue):
+    # Copies the MP3 ffmpeg writes to each segment's pipe into one upload
+
+    def __init__(self, upload):
+        super().__init__()
+        self.upload = upload
+        self.errors = []
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def write(self):
+        for data in iter(self.queue.get, None):
+            if not self.errors:
+                try:
+                    self.upload.write(data)
+                except Exception as e:
+                    self.errors.append(e)
+
+    def finish(self):
+        # Waits for everything to be written, raising anything that failed
+        self.close()
+        self.writer.join()
+        if self.errors:
+            raise self.errors[0]
+
+class LiveCues(PipeQueue):
+    # Recognizes the cues in the PCM that ffmpeg writes to a pipe while it
+    # records
+    sample_rate = 16000
+    bytes_per_sample = sample_rate * 2
+    window_size = bytes_per_sample // 4
+    triggers = {"shipping": 0.625, "forecast": 0.625, "bulletin": 0.625, "bbc": 0.5, "radio": 0.5}
+
+    def __init__(self, model_path):
+        # vosk is only needed (and only installed) for live cues
+        from vosk import Model, KaldiRecognizer, SetLogLevel
+        SetLogLevel(-1)
+        started = time.time()
+        self.rec = KaldiRecognizer(Model(model_path), self.sample_rate)
+        logging.info(f"loaded model {model_path} in {time.time() - started:.1f} s")
+        super().__init__()
+        self.cues = {}
+        self.lines = []
+        self.bytes_read = 0
+        self.error = None
+        self.recognizer = threading.Thread(target=self.recognize, daemon=True)
+        self.recognizer.start()
+
+    def recognize(self):
+        # A failure only costs the live cues: the rest of the PCM is drained
+        # so the recording carries on, and finish() reports no cues
+        try:
+            self.recognize_queue()
+        except Exception as e:
+            logging.exception("live cue recognition failed")
+            self.error = e
+            while self.queue.get() is not None:
+                pass
+
+    def recognize_queue(self):
+        seen = {}
+        line_start = 0
+        buffer = b""
+        done = False
+        while buffer or not done:
+            if len(buffer) < self.window_size and not done:
+                data = self.queue.get()
+                if data is None:
+                    done = True
+                else:
+                    buffer += data
+                continue
+            data, buffer = buffer[:self.window_size], buffer[self.window_size:]
+            complete = self.rec.AcceptWaveform(data)
+            if complete:
+                result = self.rec.Result()
+                text = json.loads(result).get("text")
+                if text:
+                    self.lines.append([round(line_start, 3), text])
+            else:
+                result = self.rec.PartialResult()
+            for trigger, cue_latency in self.triggers.items():
+                if trigger in seen: continue
+                if trigger in result:
+                    cue_start = self.bytes_read / float(self.bytes_per_sample) - cue_latency
+                    self.cues.setdefault(trigger, []).append(round(cue_start, 3))
+                    seen[trigger] = True
+            self.bytes_read += len(data)
+            if complete:
+                line_start = self.bytes_read / self.bytes_per_sample
+                seen = {}
+
+    def finish(self, filename):
+        # Waits for the rest of the PCM to be recognized and returns the
+        # same cue data as transcribe_forecast, or None if recognition failed
+        self.close()
+        self.recognizer.join()
+        if self.error:
+            return None
+        return {
+            "file": filename,
+            "cues": self.cues,
+            "transcript": self.lines,
+            "length": round(self.bytes_read / float(self.bytes_per_sample), 3)
+        }
+
+def download_stream_segment(stream, mp3_fd, pcm_fd=None):
     ffmpeg_cmd = [
         'ffmpeg',
         '-loglevel', 'info',
@@ -64,110 +304,418 @@ def download_stream_segment(stream, target):
         '-i', stream,
         '-bufsize', '8192k',
         '-f', 'mp3',
-        target
+        f"pipe:{mp3_fd}"
     ]
+    fds = (mp3_fd,)
+    if pcm_fd is not None:
+        fds += (pcm_fd,)
+        # Also decode to PCM for LiveCues, on a pipe ffmpeg inherits
+        ffmpeg_cmd += [
+            '-ar', str(LiveCues.sample_rate), '-ac', '1', '-f', 's16le',
+            f"pipe:{pcm_fd}"
+        ]
 
     logging.info(f"executing {' '.join(ffmpeg_cmd)}")
     proc = subprocess.Popen(
             ffmpeg_cmd,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
             universal_newlines=True,
             bufsize=1,
-            shell=False
+            shell=False,
+            pass_fds=fds
         )
-    return proc 
+    # ffmpeg has its own copies, so the pipes close when it exits
+    for fd in fds:
+        os.close(fd)
+    return proc
+
+def watch_progress(stderr, progress, errors):
+    # Reads ffmpeg's stderr, noting when the time= in its progress lines
+    # last moved on and keeping everything else to log afterwards
+    for line in stderr:
+        m = re.search(r"\btime=\s*(\S+)", line)
+        if m:
+            if m.group(1) != progress["time"]:
+                progress["time"] = m.group(1)
+                progress["updated"] = time.time()
+        elif line.strip():
+            errors.append(line.rstrip())
 
-def download_stream(stream, target, secs):
+def get_gaps(segments, start_time):
+    # Gaps are the time between one segment's last output and the next
+    # one's first, which is roughly how much of the broadcast was lost
+    gaps = []
+    last = None
+    for segment in segments:
+        if segment["first"] is None:
+            continue
+        if last is not None and segment["first"] > last:
+            gaps.append({"at": round(last - start_time, 3), "secs": round(segment["first"] - last, 3)})
+        last = segment["last"]
+    return gaps
+
+def download_stream(stream, recording, secs, live=None, stall_secs=10):
+    # Records each segment into recording, an UploadQueue, and live if
+    # given. ffmpeg is restarted if it exits, or if neither its output nor
+    # its progress has moved on for stall_secs. Returns a timeline of the
+    # segments and the gaps between them.
     logging.info(f"downloading {stream} for {secs} s")
 
     start_time = time.time()
     end_time = start_time + secs
     segment_number = 0
     max_segments = 20
+    segments = []
 
     # Loop until the end time is reached
     while time.time() < end_time and segment_number < max_segments:
         logging.info(f"downloading segment {segment_number}")
-        proc = download_stream_segment(stream, f"{target}.{segment_number:03d}")
-        output, errs = None, None
-        try:
-            output, errs = proc.communicate(timeout=end_time - time.time())
-        except subprocess.TimeoutExpired:
-            pass
-        if output:
-            logging.info(f"ffmpeg output: {output}")
-        if errs:
-            logging.warning(f"ffmpeg error: {errs}")
+        pcm_fd = live.open_pipe() if live else None
+        proc = download_stream_segment(stream, recording.open_pipe(), pcm_fd)
+        output = recording.pipes[-1]
+        started = time.time()
+        progress = {"time": None, "updated": started}
+        errs = []
+        watcher = threading.Thread(target=watch_progress, args=(proc.stderr, progress, errs), daemon=True)
+        watcher.start()
+        stalled = False
+        while time.time() < end_time:
+            try:
+                proc.wait(timeout=min(1, end_time - time.time()))
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            idle = time.time() - max(progress["updated"], output["last"] or started)
+            if idle > stall_secs:
+                logging.warning(f"ffmpeg stalled for {idle:.1f} s at {progress['time']}; restarting it")
+                stalled = True
+                break
         if proc.poll() is None:
             logging.info("terminating ffmpeg process")
             proc.terminate()
-            proc.wait()
-        if proc.returncode not in (0, 255):
+            try:
+                proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                # ffmpeg only notices SIGTERM between reads, which never
+                # finish if it's stalled
+                logging.warning("killing ffmpeg process")
+                proc.kill()
+                proc.wait()
+        watcher.join()
+        if errs:
+            logging.warning("ffmpeg error: " + "\n".join(errs))
+        if proc.returncode not in (0, 255) and not stalled:
             logging.error(f"ffmpeg failed with return code {proc.returncode}")
+        segments.append({"started": started, "ended": time.time(), "output": output,
+                         "stalled": stalled, "returncode": proc.returncode})
         # Start a new segment
         segment_number += 1
 
-    # Take all of the target segments and concatenate them
-    with open(target, 'wb') as f:
-        for i in range(segment_number):
-            segment = f"{target}.{i:03d}"
-            with open(segment, 'rb') as s:
-                f.write(s.read())
+    recording.finish()
+    if recording.upload.size == 0:
+        raise Exception("Recording is empty")
+
+    # Times are seconds since the recording started
+    timeline = [{
+        "start": round(segment["started"] - start_time, 3),
+        "end": round(segment["ended"] - start_time, 3),
+        "first_output": round(segment["output"]["first"] - start_time, 3) if segment["output"]["first"] else None,
+        "last_output": round(segment["output"]["last"] - start_time, 3) if segment["output"]["last"] else None,
+        "bytes": segment["output"]["bytes"],
+        "stalled": segment["stalled"],
+        "returncode": segment["returncode"]
+    } for segment in segments]
+    gaps = get_gaps([segment["output"] for segment in segments], start_time)
+    lost = sum(gap["secs"] for gap in gaps)
+    logging.info(f"downloaded {segment_number} segments, {recording.upload.size} bytes, "
+                 f"{lost:.1f} s lost in {len(gaps)} gaps")
+    return {"recorder": "ffmpeg", "segments": timeline, "gaps": gaps, "lost_secs": round(lost, 3)}
+
+def http_pool(workers):
+    retries = urllib3.Retry(total=4, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    return urllib3.PoolManager(maxsize=workers, retries=retries,
+                               timeout=urllib3.Timeout(connect=5, read=10))
+
+def http_get(http, url):
+    response = http.request("GET", url)
+    if response.status != 200:
+        raise Exception(f"GET {url} failed with status {response.status}")
+    return response.data
+
+def parse_date(text):
+    # EXT-X-PROGRAM-DATE-TIME is ISO 8601, which fromisoformat only
+    # partly understands before Python 3.11
+    text = re.sub(r"Z$", "+00:00", text.strip())
+    text = re.sub(r"([+-]\d\d)(\d\d)$", r"\1:\2", text)
+    try:
+        date = datetime.fromisoformat(text)
+        return date if date.tzinfo else pytz.utc.localize(date)
+    except ValueError:
+        logging.warning(f"can't parse date {text}")
+        return None
+
+def parse_playlist(text, url):
+    # Returns the parts of an HLS playlist the recorder needs, with URIs
+    # made absolute
+    playlist = {"variants": [], "segments": [], "map": None,
+                "target_duration": 10, "ended": False}
+    sequence = 0
+    segment = {}
+    date = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            m = re.search(r"BANDWIDTH=(\d+)", line)
+            segment = {"bandwidth": int(m.group(1)) if m else 0}
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            playlist["target_duration"] = float(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MAP:"):
+            m = re.search(r'URI="([^"]+)"', line)
+            playlist["map"] = urljoin(url, m.group(1)) if m else None
+        elif line.startswith("#EXTINF:"):
+            segment["duration"] = float(line.split(":", 1)[1].split(",")[0])
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            segment["date"] = parse_date(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-ENDLIST"):
+            playlist["ended"] = True
+        elif line and not line.startswith("#"):
+            if "bandwidth" in segment:
+                playlist["variants"].append((segment["bandwidth"], urljoin(url, line)))
+            else:
+                # Segments without their own date follow on from the last one
+                date = segment.get("date", date)
+                duration = segment.get("duration", 0)
+                playlist["segments"].append({"sequence": sequence, "uri": urljoin(url, line),
+                    "duration": duration, "date": date})
+                sequence += 1
+                date = date + timedelta(seconds=duration) if date else None
+            segment = {}
+    return playlist
+
+def get_media_playlist(http, url):
+    # Follows a master playlist to its highest bandwidth variant
+    playlist = parse_playlist(http_get(http, url).decode("utf-8"), url)
+    if playlist["variants"]:
+        url = max(playlist["variants"])[1]
+        logging.info(f"recording variant {url}")
+        playlist = parse_playlist(http_get(http, url).decode("utf-8"), url)
+    return url, playlist
+
+def find_start(segments, start):
+    # Returns the sequence number of the segment playing at start, or None
+    # if the playlist hasn't reached start yet. Segments before the rewind
+    # window are gone, so if start is earlier than that the recording
+    # starts late.
+    for segment in segments:
+        if segment["date"] and segment["date"] + timedelta(seconds=segment["duration"]) > start:
+            if segment["date"] > start:
+                logging.warning(f"{start} is before the playlist's window; "
+                                f"missed {(segment['date'] - start).total_seconds():.1f} s")
+            return segment["sequence"]
+    return None
+
+def transcode(mp3_fd, pcm_fd=None):
+    # Starts the one ffmpeg that turns the segments written to its stdin
+    # into MP3 (and PCM for LiveCues)
+    ffmpeg_cmd = ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-f', 'mp3', f"pipe:{mp3_fd}"]
+    fds = (mp3_fd,)
+    if pcm_fd is not None:
+        fds += (pcm_fd,)
+        ffmpeg_cmd += ['-ar', str(LiveCues.sample_rate), '-ac', '1', '-f', 's16le', f"pipe:{pcm_fd}"]
+    logging.info(f"executing {' '.join(ffmpeg_cmd)}")
+    proc = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, pass_fds=fds)
+    for fd in fds:
+        os.close(fd)
+    return proc
+
+def download_hls(stream, recording, secs, live=None, workers=4, live_start_index=-3, http=None,
+                 start=None):
+    # Records secs of media from an HLS stream by polling its playlist and
+    # fetching new segments concurrently over one connection pool. Segments
+    # are written to ffmpeg strictly in media sequence order, once each, so
+    # the only gaps are segments that left the playlist before they could
+    # be fetched, and those are logged.
+    #
+    # If start is given, recording starts from the segment playing at that
+    # time according to EXT-X-PROGRAM-DATE-TIME, whether that's back in
+    # the playlist's rewind window or still to come, so there's no need to
+    # wait for it. Without dates it waits until start and starts live.
+    #
+    # Like the ffmpeg recorder, it carries on through network errors until
+    # the deadline, and if anything else goes wrong it still returns what it
+    # recorded so far rather than losing the whole recording.
+    logging.info(f"downloading {stream} for {secs} s" + (f" from {start}" if start else ""))
+    http = http or http_pool(workers)
+    url, playlist = get_media_playlist(http, stream)
+    segments = playlist["segments"]
+    if start and segments and segments[0]["date"] is None:
+        logging.warning("playlist has no EXT-X-PROGRAM-DATE-TIME, so recording live from start")
+        wait_until(start)
+        start = None
+        url, playlist = get_media_playlist(http, stream)
+    deadline = max(time.time(), start.timestamp() if start else 0) + secs + 6 * playlist["target_duration"]
+    proc = transcode(recording.open_pipe(), live.open_pipe() if live else None)
+    fetches = {}
+    recorded = 0
+    next_sequence = None
+    timeline = []
+    gaps = []
+    init = playlist["map"]
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while recorded < secs and time.time() < deadline:
+                    if init:
+                        # fMP4 segments can't be decoded without it, so nothing
+                        # is written until it's arrived
+                        try:
+                            data = http_get(http, init)
+                        except Exception as e:
+                            logging.warning(f"can't fetch the initialization section: {e}")
+                            time.sleep(playlist["target_duration"] / 2)
+                            continue
+                        proc.stdin.write(data)
+                        init = None
+                    segments = playlist["segments"]
+                    if next_sequence is None and start and segments:
+                        next_sequence = find_start(segments, start)
+                    elif next_sequence is None and segments:
+                        recent = segments[live_start_index:] if not playlist["ended"] else segments
+                        next_sequence = recent[0]["sequence"]
+                    for segment in segments:
+                        if next_sequence is not None and segment["sequence"] >= next_sequence \
+                                and segment["sequence"] not in fetches:
+                            fetches[segment["sequence"]] = (segment, executor.submit(http_get, http, segment["uri"]))
+                    # Write whatever's arrived, in order
+                    while next_sequence is not None and recorded < secs:
+                        if next_sequence not in fetches:
+                            waiting = [n for n in fetches if n > next_sequence]
+                            if not waiting:
+                                break
+                            gap = min(waiting) - next_sequence
+                            logging.warning(f"missed {gap} segments from {next_sequence}")
+                            # The missed segments' durations are only known if they
+                            # have dates; otherwise they're assumed to be full length
+                            following = fetches[min(waiting)][0]["date"]
+                            expected = timeline[-1]["end_date"] if timeline else None
+                            missed = (following - expected).total_seconds() if following and expected \
+                                else gap * playlist["target_duration"]
+                            gaps.append({"at": round(recorded, 3), "segments": gap, "secs": round(missed, 3)})
+                            next_sequence = min(waiting)
+                        segment, fetch = fetches.pop(next_sequence)
+                        try:
+                            data = fetch.result()
+                        except Exception as e:
+                            logging.warning(f"can't fetch segment {segment['sequence']}: {e}")
+                            gaps.append({"at": round(recorded, 3), "segments": 1, "secs": segment["duration"]})
+                        else:
+                            proc.stdin.write(data)
+                            timeline.append({"sequence": segment["sequence"], "start": round(recorded, 3),
+                                "duration": segment["duration"], "bytes": len(data), "date": segment["date"],
+                                "end_date": segment["date"] + timedelta(seconds=segment["duration"]) if segment["date"] else None})
+                            recorded += segment["duration"]
+                        next_sequence += 1
+                    if playlist["ended"] and not fetches:
+                        break
+                    if recorded < secs:
+                        time.sleep(playlist["target_duration"] / 2)
+                        try:
+                            playlist = parse_playlist(http_get(http, url).decode("utf-8"), url)
+                        except Exception as e:
+                            # Segments that leave the window before the next
+                            # refresh that works are logged as a gap then
+                            logging.warning(f"can't refresh the playlist: {e}")
+            finally:
+                for segment, fetch in fetches.values():
+                    fetch.cancel()
+    except Exception:
+        # e.g. ffmpeg has died, so nothing more can be recorded
+        logging.exception("HLS recording failed; keeping what was recorded")
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        proc.wait()
+    if recorded < secs and not playlist["ended"]:
+        logging.warning(f"stopped with {secs - recorded:.1f} s still to record")
+        gaps.append({"at": round(recorded, 3), "segments": 0, "secs": round(secs - recorded, 3)})
+    if proc.returncode != 0:
+        logging.error(f"ffmpeg failed with return code {proc.returncode}")
+
+    recording.finish()
+    if recording.upload.size == 0:
+        raise Exception("Recording is empty")
+    lost = sum(gap["secs"] for gap in gaps)
+    logging.info(f"downloaded {recorded:.1f} s, {recording.upload.size} bytes, "
+                 f"{lost:.1f} s lost in {len(gaps)} gaps")
+    # Times are seconds into the recording
+    for segment in timeline:
+        segment["date"] = segment["date"].isoformat() if segment["date"] else None
+        del segment["end_date"]
+    return {"recorder": "hls", "segments": timeline, "gaps": gaps, "lost_secs": round(lost, 3)}
 
-    # Verify the output file exists and has content
-    if not os.path.exists(target) or os.path.getsize(target) == 0:
-        raise Exception("Output file is missing or empty")
+def generate_file_name(when=None):
+    return (when or local_now()).strftime("%Y%m%dZ%H%M") + '.mp3'
 
-    logging.info(f"downloaded {segment_number} segments to {target}")
-    return True
+def scheduled_start(hour, minute):
+    now = local_now()
+    return london.localize(
+        datetime(now.year, now.month, now.day, hour, minute))
 
+def wait_until(start):
+    delay = (start - local_now()).total_seconds()
+    if delay > 0:
+        logging.info(f"waiting {delay:.1f} sec until {start:%H:%M}")
+        time.sleep(delay)
 
-def upload_file(filename, bucket, object_name=None):
-    if object_name is None:
-        object_name = os.path.basename(filename)
+def upload_json(data, bucket, object_name):
     s3_client = boto3.client('s3')
-    extra_args = {'ACL': 'public-read', 'ContentType': 'audio/mpeg'}
-    logging.info(f"uploading {filename} to s3://{bucket}/{object_name}")
+    logging.info(f"uploading s3://{bucket}/{object_name}")
     if in_production():
-        s3_client.upload_file(
-            filename, bucket, object_name, ExtraArgs=extra_args)
+        s3_client.put_object(
+            Bucket=bucket, Key=object_name, Body=json.dumps(data).encode("utf-8"),
+            ACL='public-read', ContentType='application/json')
         return True
     else:
         logging.info(f"(not running in production; upload skipped)")
         return False
 
-def generate_file_name():
-    return local_now().strftime("%Y%m%dZ%H%M") + '.mp3'
-
-def wait_until(hour, minute):
-    now = local_now()
-    start = london.localize(
-        datetime(now.year, now.month, now.day, hour, minute))
-    delay = (start - now).total_seconds()
-    if delay > 0:
-        logging.info(f"waiting {delay:.1f} sec until {hour:02d}:{minute:02d}")
-        time.sleep(delay)
+def record_stream(stream, bucket, prefix, duration, live=None, part_size=8 << 20,
+                  download=download_stream, start=None):
+    # Compute the filename at the minute we care about, which is start if
+    # the recorder can go back to it. Returns the key of the recording, and
+    # its cues if live is a LiveCues. The recorder's timeline of segments
+    # and gaps goes next to the recording.
+    filename = generate_file_name(start)
+    with open_upload(bucket, prefix + filename, part_size) as upload:
+        timeline = download(stream, UploadQueue(upload), duration, live)
+    try:
+        upload_json({"file": filename, **timeline}, bucket, prefix + filename + ".timeline.json")
+    except Exception:
+        logging.exception("can't upload the timeline")
+    cues = live.finish(filename) if live else None
+    if live and not cues:
+        logging.warning("no live cues, so the recording will be transcribed")
+    if cues:
+        logging.info(f"recognized cues {cues['cues']}")
+    return (prefix + filename if in_production() else ""), cues
 
-def record_stream(stream, bucket, prefix, duration):
-    # Compute the filename at the minute we care about
-    filename = generate_file_name()
-    with tempfile.TemporaryDirectory() as tempdir:
-        target = os.path.join(tempdir, filename)
-        if download_stream(stream, target, duration) \
-                and upload_file(target, bucket, prefix + filename):
-            return prefix + filename
-    return ""
-
-def set_next_launch(test_date=None):
+def set_next_launch(test_date=None, recorder="ffmpeg"):
     now = test_date or local_now()
     tomorrow = now + timedelta(days=1)
     events = boto3.client('events')
+    # ffmpeg has to be running before the broadcast starts, but the HLS
+    # recorder can go back to the start in the playlist's rewind window
+    lead = timedelta(minutes=1) if recorder != "hls" else timedelta(0)
 
     for hour, minute, days_of_week in broadcast_times:
         start = london.localize(
             datetime(tomorrow.year, tomorrow.month, tomorrow.day, hour, minute)
-            - timedelta(minutes=1))
+            - lead)
 
         if now.dst() != start.dst():
             logging.info(f"*** difference in DST detected for tomorrow at {hour:02}:{minute:02}! ***")
@@ -192,23 +740,55 @@ def start_transcription(file):
         Payload=json.dumps({"files": [file]})
     )
 
+def start_catalog(file, data):
+    lambda_ = boto3.client('lambda')
+    logging.info(f"Initiating catalog of {file}")
+    lambda_.invoke(
+        FunctionName="catalog-forecast",
+        InvocationType="Event",
+        Payload=json.dumps({"files": [{"file": file, "cues": data["cues"], "length": data["length"]}]})
+    )
+
 def handle_event(event, context):
     set_log_level()
     duration = int(event.get("duration", 12*60))
+    recorder = event.get("recorder", "ffmpeg")
     try:
         hour, minute = map(int, event["time"].split(":"))
         config = get_config()
+        recorder = event.get("recorder", config["recorder"])
         stream = event.get("stream", config["stream"])
         bucket, prefix = config["bucket"], config["prefix"]
-        wait_until(hour, minute)
-        recording = record_stream(stream, bucket, prefix, duration)
-        if recording:
+        live = None
+        if event.get("live_cues", config["live_cues"]):
+            # Without the model the recording is transcribed afterwards instead
+            try:
+                live = LiveCues(config["model"])
+            except Exception:
+                logging.exception("can't start live cues")
+        start = scheduled_start(hour, minute)
+        if recorder == "hls":
+            # No waiting: download_hls starts from the scheduled time
+            # wherever it is in the playlist
+            download = partial(download_hls, workers=config["hls_workers"],
+                               live_start_index=config["hls_live_start_index"], start=start)
+        else:
+            download = partial(download_stream, stall_secs=config["stall_secs"])
+            wait_until(start)
+            start = None
+        recording, cues = record_stream(stream, bucket, prefix, duration, live,
+                                        config["upload_part_size"], download, start)
+        if recording and cues:
+            # Already recognized, so it can go straight to the catalog
+            upload_json(cues, bucket, config["cue_prefix"] + os.path.basename(recording) + ".json")
+            start_catalog(recording, cues)
+        elif recording:
             start_transcription(recording)
     except Exception as e:
         logging.exception("handle_event failure")
         notify("handle_event failure")
     try:
-        set_next_launch(event.get("test_date"))
+        set_next_launch(event.get("test_date"), recorder)
     except Exception as e:
         logging.exception("set_next_launch failure")
         notify("set_next_launch failure")
@@ -216,12 +796,13 @@ def handle_event(event, context):
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1 and sys.argv[1] == "-s":
-        # Run `python3 download_forecast.py -s` to ensure that Eventbridge rules are DST aware
+        # Run `python3 download_forecast.py -s [date] [recorder]` to ensure that
+        # Eventbridge rules are DST aware
         set_log_level()
         when = None
-        if len(sys.argv) > 2:
+        if len(sys.argv) > 2 and sys.argv[2] != "-":
             when = london.localize(datetime.strptime(sys.argv[2], "%Y-%m-%d"))
-        set_next_launch(when)
+        set_next_launch(when, sys.argv[3] if len(sys.argv) > 3 else "ffmpeg")
     else:
         when = local_now() + timedelta(minutes=1)
         start = f"{when.hour:02}:{when.minute:02}"
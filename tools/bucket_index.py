@@ -0,0 +1,169 @@
+"""A local SQLite index of the objects in the archive bucket.
+
+The tools query this instead of listing the whole bucket every time. Most
+of the bucket's keys are named after broadcasts, so new objects sort after
+the last one indexed under their prefix: an ordinary sync only lists what
+comes after that (StartAfter), which also catches the few other keys like
+archive/catalog.json that sort after the dates. The top level is listed
+every time too, so new prefixes and top-level keys are found straight away.
+Changed or deleted objects elsewhere are only picked up by a full sync,
+which happens every FULL_SYNC_DAYS or when asked for, so the index's ETags
+can be out of date for objects that are rewritten in place, like cue files.
+
+Content types and ACLs need a request per object, so they're only fetched
+with details=True, and then only for objects whose ETag has changed since.
+Objects found to be deleted then are dropped from the index.
+
+    python3 bucket_index.py [--full] [--details] [prefix]
+
+syncs the index and lists the keys under prefix.
+"""
+import boto3, os, re, sqlite3, sys, time
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+BUCKET = "gale8-uk"
+INDEX_PATH = os.path.expanduser("~/.cache/gale8/index.sqlite")
+FULL_SYNC_DAYS = 7
+ALL_USERS = "http://acs.amazonaws.com/groups/global/AllUsers"
+broadcast_key = re.compile(r"(.*/)?\d{8}Z\d{4}\.mp3.*")
+
+def open_index(path=INDEX_PATH):
+    """Opens the index, creating it if it doesn't exist yet."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE IF NOT EXISTS objects (
+        key TEXT PRIMARY KEY, size INTEGER, etag TEXT, last_modified TEXT,
+        content_type TEXT, public_read INTEGER, details_etag TEXT)""")
+    # start_after is the last broadcast key under the prefix
+    db.execute("""CREATE TABLE IF NOT EXISTS prefixes (
+        prefix TEXT PRIMARY KEY, start_after TEXT, full_sync REAL)""")
+    if db.execute("PRAGMA user_version").fetchone()[0] < 1:
+        # public_read used to count any READ grant, so details are fetched
+        # again
+        db.execute("UPDATE objects SET details_etag = NULL")
+        db.execute("PRAGMA user_version = 1")
+        db.commit()
+    return db
+
+def upsert(db, obj):
+    # Content type and ACL are forgotten if the object has changed
+    db.execute("""INSERT INTO objects (key, size, etag, last_modified) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            size = excluded.size, last_modified = excluded.last_modified,
+            content_type = CASE WHEN etag = excluded.etag THEN content_type END,
+            public_read = CASE WHEN etag = excluded.etag THEN public_read END,
+            etag = excluded.etag""",
+        (obj["Key"], obj["Size"], obj["ETag"], obj["LastModified"].isoformat()))
+
+def list_prefix(db, client, bucket, prefix, start_after=""):
+    """Indexes everything under prefix after start_after, returning the keys
+    seen and the last broadcast key among them."""
+    paginator = client.get_paginator("list_objects_v2")
+    keys = []
+    last = start_after
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, StartAfter=start_after):
+        for obj in page.get("Contents", []):
+            upsert(db, obj)
+            keys.append(obj["Key"])
+            if broadcast_key.fullmatch(obj["Key"]):
+                last = max(last, obj["Key"])
+    return keys, last
+
+def list_top_level(db, client, bucket):
+    """Indexes the keys at the top level, dropping those that are no longer
+    there, and returns the prefixes."""
+    paginator = client.get_paginator("list_objects_v2")
+    prefixes = []
+    seen = set()
+    for page in paginator.paginate(Bucket=bucket, Delimiter="/"):
+        prefixes += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+        for obj in page.get("Contents", []):
+            upsert(db, obj)
+            seen.add(obj["Key"])
+    gone = [(key,) for key, in db.execute("SELECT key FROM objects WHERE key NOT LIKE '%/%'") if key not in seen]
+    db.executemany("DELETE FROM objects WHERE key = ?", gone)
+    return prefixes, seen
+
+def full_sync(db, client, bucket):
+    # Lists everything under every prefix, dropping whatever's no longer
+    # there
+    prefixes, seen = list_top_level(db, client, bucket)
+    now = time.time()
+    db.execute("DELETE FROM prefixes")
+    for prefix in prefixes:
+        keys, last = list_prefix(db, client, bucket, prefix)
+        seen.update(keys)
+        db.execute("INSERT INTO prefixes VALUES (?, ?, ?)", (prefix, last, now))
+    gone = [(key,) for key, in db.execute("SELECT key FROM objects") if key not in seen]
+    db.executemany("DELETE FROM objects WHERE key = ?", gone)
+    print(f"indexed {len(seen)} objects under {len(prefixes)} prefixes, {len(gone)} gone", file=sys.stderr)
+
+def get_details(client, bucket, key):
+    head = client.head_object(Bucket=bucket, Key=key)
+    grants = client.get_object_acl(Bucket=bucket, Key=key)["Grants"]
+    public_read = any(g["Permission"] == "READ" and g["Grantee"].get("URI") == ALL_USERS for g in grants)
+    return head.get("ContentType", ""), public_read, head["ETag"]
+
+def try_get_details(client, bucket, key):
+    # Returns the details, or the error fetching them
+    try:
+        return get_details(client, bucket, key), None
+    except Exception as e:
+        return None, e
+
+def refresh_details(db, client, bucket, workers=16):
+    # Fetches the content type and ACL of every object that's changed since
+    # they were last fetched. Objects deleted since they were listed are
+    # dropped from the index, and any other failure is reported and left
+    # for the next sync.
+    rows = db.execute("SELECT key FROM objects WHERE details_etag IS NOT etag").fetchall()
+    keys = [key for key, in rows]
+    gone = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, (details, error) in zip(keys, executor.map(lambda key: try_get_details(client, bucket, key), keys)):
+            if isinstance(error, ClientError) and error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                db.execute("DELETE FROM objects WHERE key = ?", (key,))
+                gone += 1
+            elif error:
+                print(f"can't fetch details of {key}: {error}", file=sys.stderr)
+                failed += 1
+            else:
+                db.execute("UPDATE objects SET content_type = ?, public_read = ?, details_etag = ? WHERE key = ?",
+                           (*details, key))
+    if keys:
+        print(f"fetched details of {len(keys) - gone - failed} objects, {gone} gone, {failed} failed",
+              file=sys.stderr)
+
+def sync(full=False, details=False, bucket=BUCKET, path=INDEX_PATH):
+    """Brings the index up to date and returns it.
+
+    Args:
+        full: List the whole bucket even if the last full sync was recent.
+        details: Also fetch content types and ACLs where they're unknown.
+    """
+    db = open_index(path)
+    client = boto3.client("s3")
+    prefixes = db.execute("SELECT prefix, start_after, full_sync FROM prefixes").fetchall()
+    if full or not prefixes or min(p[2] for p in prefixes) < time.time() - FULL_SYNC_DAYS * 86400:
+        full_sync(db, client, bucket)
+    else:
+        known = {prefix: start_after for prefix, start_after, _ in prefixes}
+        for prefix in list_top_level(db, client, bucket)[0]:
+            if prefix not in known:
+                # New since the last full sync, so listed in full
+                _, last = list_prefix(db, client, bucket, prefix)
+                db.execute("INSERT INTO prefixes VALUES (?, ?, ?)", (prefix, last, time.time()))
+            else:
+                _, last = list_prefix(db, client, bucket, prefix, known[prefix])
+                db.execute("UPDATE prefixes SET start_after = ? WHERE prefix = ?", (last, prefix))
+    if details:
+        refresh_details(db, client, bucket)
+    db.commit()
+    return db
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    db = sync(full="--full" in sys.argv, details="--details" in sys.argv)
+    for key, in db.execute("SELECT key FROM objects WHERE key LIKE ? ORDER BY key", ((args[0] if args else "") + "%",)):
+        print(key)
@@ -1,10 +1,18 @@
-import boto3, sys, re, json
+import boto3, sys, os, re, json
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "catalog"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from catalog_forecast import get_trim
+import bucket_index
 
 session = boto3.Session()
 s3 = session.resource('s3')
 bucket = s3.Bucket('gale8-uk')
 
 prefix = "archive"
+cue_prefix = "cues"
 broadcast_times = ("0048", "0520", "1201", "1754")
 filename = re.compile(f".*{prefix}/(....)(..)(..)Z(....).mp3$")
 catalog = {}
@@ -15,26 +23,60 @@ if len(sys.argv) > 1:
         for line in exclude_file:
             exclude.add(line.strip())
 
-for obj in bucket.objects.filter(Prefix=f"{prefix}/"):
-    m = filename.match(obj.key)
+index = bucket_index.sync()
+for key, in index.execute("SELECT key FROM objects WHERE key LIKE ? ORDER BY key", (f"{prefix}/%",)):
+    m = filename.match(key)
     if not m:
-        if obj.key != f"{prefix}/catalog.json":
-            print('no match:', obj.key, file=sys.stderr)
+        if key != f"{prefix}/catalog.json" and not key.startswith(f"{prefix}/catalog/") \
+                and not key.endswith(".timeline.json"):
+            print('no match:', key, file=sys.stderr)
         continue
-    if obj.key in exclude:
-        print('excluded:', obj.key, file=sys.stderr)
+    if key in exclude:
+        print('excluded:', key, file=sys.stderr)
         continue
     year, month, day, timing = m.groups()
     if timing not in broadcast_times:
-        print('wrong time:', obj.key, file=sys.stderr)
+        print('wrong time:', key, file=sys.stderr)
         continue
     catalog.setdefault(year, {}) \
            .setdefault(month, {}) \
            .setdefault(day, []) \
            .append(timing)
 
+# Per-year shards plus a manifest listing them, alongside the single file
+shards = {year: f"{prefix}/catalog/{year}.json" for year in catalog}
+manifest = {"shards": {}, "count": 0, "latest": ""}
+for year, shard in catalog.items():
+    count = sum(len(timings) for days in shard.values() for timings in days.values())
+    month = max(shard)
+    day = max(shard[month])
+    manifest["shards"][year] = {"key": shards[year], "count": count, "trims": f"{prefix}/catalog/{year}.trims.json"}
+    manifest["count"] += count
+    manifest["latest"] = max(manifest["latest"], f"{year}{month}{day}Z{max(shard[month][day])}")
+
+# Trim points for every broadcast, so assemble doesn't need the full cues
+def read_trim(broadcast):
+    try:
+        data = json.load(bucket.Object(f"{cue_prefix}/{broadcast}.mp3.json").get()["Body"])
+    except ClientError as e:
+        print('no cues:', broadcast, e, file=sys.stderr)
+        return None
+    return get_trim(data)
+
+broadcasts = [f"{year}{month}{day}Z{timing}"
+              for year, months in catalog.items()
+              for month, days in months.items()
+              for day, timings in days.items()
+              for timing in timings]
+with ThreadPoolExecutor(max_workers=16) as executor:
+    trims = {broadcast: trim for broadcast, trim in zip(broadcasts, executor.map(read_trim, broadcasts)) if trim}
+
 with open("catalog.json", "w") as f:
     json.dump(catalog, f)
+with open("manifest.json", "w") as f:
+    json.dump(manifest, f)
+with open("trims.json", "w") as f:
+    json.dump(trims, f)
 
 # Upload the file if it's not a dry run
 if len(sys.argv) > 2 and sys.argv[2] == "--dry-run":
@@ -42,3 +84,9 @@ if len(sys.argv) > 2 and sys.argv[2] == "--dry-run":
 
 # Upload the catalog to the existing bucket object making it public and setting the correct content type
 bucket.put_object(Key="archive/catalog.json", Body=json.dumps(catalog), ACL="public-read", ContentType="application/json")
+for year, key in shards.items():
+    bucket.put_object(Key=key, Body=json.dumps(catalog[year]), ACL="public-read", ContentType="application/json")
+for year, entry in manifest["shards"].items():
+    year_trims = {broadcast: trim for broadcast, trim in trims.items() if broadcast.startswith(year)}
+    bucket.put_object(Key=entry["trims"], Body=json.dumps(year_trims), ACL="public-read", ContentType="application/json")
+bucket.put_object(Key=f"{prefix}/catalog/manifest.json", Body=json.dumps(manifest), ACL="public-read", ContentType="application/json")
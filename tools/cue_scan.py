@@ -0,0 +1,176 @@
+"""Scans the cue files in the archive bucket for problems in one pass.
+
+Lists cues/ once with a paginator and fetches the cue JSON through a thread
+pool, keeping a local copy of each file along with its ETag so that later
+scans only fetch the files that have changed. Checks are functions of
+(filename, cue data) that return a line to report, or None.
+
+    python3 cue_scan.py [check ...]
+
+runs the named checks (all of them by default) and prints what they find.
+"""
+import boto3, json, os, sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+BUCKET = "gale8-uk"
+PREFIX = "cues/"
+CACHE_DIR = os.path.expanduser("~/.cache/gale8/cues")
+
+def check_for_keywords(cue_file_content):
+    """Checks if a cue file contains any of the required keywords."""
+    keywords = ["shipping", "forecast", "bulletin", "bbc", "radio"]
+    if "cues" not in cue_file_content:
+        return False
+    cues = cue_file_content["cues"]
+    for keyword in keywords:
+        if keyword in cues:
+            return True
+    return False
+
+def get_expected_length(filename):
+    """Returns the expected length in seconds for a given filename.
+
+    Args:
+        filename: The filename in the format yymmddZHHMM.mp3.
+
+    Returns:
+        The expected length in seconds.
+    """
+    try:
+        # Extract HHMM from the filename
+        hhmm = filename[-8:-4]
+
+        if hhmm == "0048" or hhmm == "0520":
+            return 720
+        elif hhmm == "1754" or hhmm == "1201":
+            return 360
+        else:
+            return 0  # Unknown broadcast time
+    except (IndexError, ValueError):
+        return 0  # Invalid filename format
+
+def missing_keywords(filename, data):
+    """Reports recordings whose cues have none of the keywords."""
+    if not check_for_keywords(data):
+        return filename
+
+def short_recording(filename, data):
+    """Reports recordings no more than half as long as expected."""
+    if "length" in data:
+        length = data["length"]
+        expected_length = get_expected_length(filename)
+        if expected_length > 0 and length <= expected_length / 2:
+            return filename + " " + str(length)
+
+def empty_cues(filename, data):
+    """Reports recordings with no cues at all."""
+    if not data.get("cues"):
+        return filename
+
+def no_start(filename, data):
+    """Reports recordings that can't be cataloged because nothing marks the
+    start of the forecast."""
+    cues = data.get("cues")
+    if cues and "shipping" not in cues and "forecast" not in cues:
+        return filename
+
+CHECKS = {
+    "missing": missing_keywords,
+    "short": short_recording,
+    "empty": empty_cues,
+    "no-start": no_start,
+}
+
+class CueCache:
+    """Cue data on disk, one file per key, only returned if the ETag
+    still matches."""
+
+    def __init__(self, path=CACHE_DIR):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, quote(key, safe=""))
+
+    def get(self, key, etag):
+        try:
+            with open(self.filename(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry["data"] if entry.get("etag") == etag else None
+
+    def put(self, key, etag, data):
+        # Written to a temporary file first so a scan that's interrupted
+        # never leaves a half-written entry
+        filename = self.filename(key)
+        with open(filename + ".tmp", "w") as f:
+            json.dump({"etag": etag, "data": data}, f)
+        os.replace(filename + ".tmp", filename)
+
+def list_cue_files(client, bucket=BUCKET, prefix=PREFIX):
+    """Yields (key, ETag) for every cue file."""
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".json"):
+                yield obj["Key"], obj["ETag"]
+
+def scan(checks, bucket=BUCKET, prefix=PREFIX, workers=16, cache=None, stats=None):
+    """Runs every check over every cue file, yielding (check name, line)
+    for each problem found, in key order.
+
+    Args:
+        checks: A dict of check name to check function.
+        cache: A CueCache, or None to fetch everything.
+        stats: A dict that gets counts of files "fetched", "cached" and
+            "failed".
+    """
+    client = boto3.client("s3")
+    stats = stats if stats is not None else {}
+    for count in ("fetched", "cached", "failed"):
+        stats.setdefault(count, 0)
+
+    def load(obj):
+        key, etag = obj
+        data = cache.get(key, etag) if cache else None
+        if data is not None:
+            return key, data, "cached"
+        try:
+            response = client.get_object(Bucket=bucket, Key=key)
+            data = json.loads(response["Body"].read().decode("utf-8"))
+        except Exception as e:
+            print(f"can't read {key}: {e}", file=sys.stderr)
+            return key, None, "failed"
+        if cache:
+            cache.put(key, response["ETag"], data)
+        return key, data, "fetched"
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, data, source in executor.map(load, list_cue_files(client, bucket, prefix)):
+            stats[source] += 1
+            if data is None:
+                continue
+            filename = key[len(prefix):-len(".json")]
+            for name, check in checks.items():
+                line = check(filename, data)
+                if line is not None:
+                    yield name, line
+
+def main(names=None):
+    """Prints what the named checks find, prefixed by the check's name if
+    there's more than one."""
+    names = names or list(CHECKS)
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        sys.exit(f"unknown checks {', '.join(unknown)}; choose from {', '.join(CHECKS)}")
+    stats = {}
+    # Listed rather than taken from bucket_index, whose ETags for cue files
+    # that have been rewritten can be out of date until its next full sync
+    for name, line in scan({name: CHECKS[name] for name in names}, cache=CueCache(), stats=stats):
+        print(line if len(names) == 1 else f"{name}\t{line}")
+    print(f"fetched {stats['fetched']}, cached {stats['cached']}, failed {stats['failed']}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
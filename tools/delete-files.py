@@ -1,24 +1,18 @@
-import boto3
-import sys
+import os, sys
 
-def delete_files(bucket_name, mp3_filenames):
-    """Deletes MP3 files and their corresponding JSON cue files from S3."""
-    session = boto3.Session()
-    s3 = session.resource('s3')
-    bucket = s3.Bucket(bucket_name)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from maintenance import Maintenance, get_options
 
+def delete_files(bucket_name, mp3_filenames, **options):
+    """Deletes MP3 files and their corresponding JSON cue files from S3."""
+    keys = []
     for mp3_filename in mp3_filenames:
-        # Delete MP3 file
-        mp3_key = f"archive/{mp3_filename}"
-        bucket.delete_objects(Delete={'Objects': [{'Key': mp3_key}]})
-        print(f"Deleted: s3://{bucket_name}/{mp3_key}")
-
-        # Delete corresponding JSON cue file
-        json_key = f"cues/{mp3_filename.replace('.mp3', '.json')}"
-        bucket.delete_objects(Delete={'Objects': [{'Key': json_key}]})
-        print(f"Deleted: s3://{bucket_name}/{json_key}")
+        keys.append(f"archive/{mp3_filename}")
+        keys.append(f"cues/{mp3_filename}.json")
+    for key in Maintenance(bucket_name, **options).delete(keys):
+        print(f"Deleted: s3://{bucket_name}/{key}")
 
 if __name__ == "__main__":
     bucket_name = 'gale8-uk'
-    mp3_filenames = [line.strip() for line in sys.stdin if line]
-    delete_files(bucket_name, mp3_filenames)
+    mp3_filenames = [line.strip() for line in sys.stdin if line.strip()]
+    delete_files(bucket_name, mp3_filenames, **get_options(sys.argv))
@@ -27,9 +27,34 @@ def get_model(output):
     rec = KaldiRecognizer(model, sample_rate)
     output_path = output
 
+def output_file(filename):
+    return f"{output_path}/{os.path.basename(filename)}.json"
+
+def is_done(filename, journal):
+    # Done if the journal has this version of the file, or its cues are
+    # newer than it
+    mtime = os.path.getmtime(filename)
+    if journal.get(filename) == mtime:
+        return True
+    output = output_file(filename)
+    return os.path.exists(output) and os.path.getmtime(output) >= mtime
+
+def read_journal(path):
+    # {filename: mtime} for every file an earlier run finished
+    journal = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # cut short by a crash
+                journal[entry["file"]] = entry["mtime"]
+    return journal
+
 def detect(filename):
     if not os.path.exists(filename):
-        return ("", [])
+        return (filename, None, 0, 0)
 
     process = subprocess.Popen(
             ['ffmpeg', '-loglevel', 'quiet', '-i',
@@ -69,23 +94,59 @@ def detect(filename):
             line_start = bytes_read / bytes_per_sample
             seen = {}
 
+    # Written under another name first, so a crash never leaves cues that
+    # look newer than the audio
     basename = os.path.basename(filename)
-    with open(f"{output_path}/{basename}.json", "w") as f:
+    length = round(bytes_read / float(bytes_per_sample), 3)
+    output = output_file(filename)
+    with open(output + ".tmp", "w") as f:
         json.dump({
             "file": basename,
             "cues": cues,
             "transcript": lines,
-            "length": round(bytes_read / float(bytes_per_sample), 3)
+            "length": length
         }, f)
+    os.replace(output + ".tmp", output)
 
-    print("{} {} ({:.2f}s elapsed)".format(filename, cues, time.time() - start), file=sys.stderr)
-    return (filename, cues)
+    return (filename, cues, length, time.time() - start)
 
 if __name__ == "__main__":
-    output_path = sys.argv[1]
-    files = sys.argv[2:]
-    if not output_path or not files:
-        raise Error(f"Usage: {sys.argv[0]} <output_path> <files>...")
-    with multiprocessing.Pool(processes=6, initializer=get_model, initargs=(output_path,)) as p:
-        for filename, cues in p.map(detect, files):
+    # Usage: detect_forecast.py [-j workers] [--force] <output_path> <files>...
+    #
+    # Files whose cues are newer than them, or that the journal in
+    # output_path says are done, are skipped unless --force is given, so
+    # an interrupted run picks up where it stopped.
+    args = sys.argv[1:]
+    workers = os.cpu_count()
+    if args[:1] == ["-j"]:
+        workers = int(args[1])
+        args = args[2:]
+    force = "--force" in args
+    args = [arg for arg in args if arg != "--force"]
+    if len(args) < 2:
+        sys.exit(f"Usage: {sys.argv[0]} [-j workers] [--force] <output_path> <files>...")
+    output_path, files = args[0], args[1:]
+
+    journal_path = f"{output_path}/journal.jsonl"
+    journal = read_journal(journal_path)
+    todo = [f for f in files if force or not os.path.exists(f) or not is_done(f, journal)]
+    print(f"{len(files) - len(todo)} of {len(files)} files already done; "
+          f"detecting {len(todo)} with {workers} workers", file=sys.stderr)
+
+    started = time.time()
+    total_length = 0
+    with open(journal_path, "a") as journal_file, \
+            multiprocessing.Pool(processes=workers, initializer=get_model, initargs=(output_path,)) as p:
+        for done, (filename, cues, length, elapsed) in enumerate(p.imap_unordered(detect, todo), 1):
+            if cues is None:
+                print(f"{filename} doesn't exist", file=sys.stderr)
+                continue
+            journal_file.write(json.dumps({"file": filename, "mtime": os.path.getmtime(filename),
+                                           "length": length, "elapsed": round(elapsed, 3)}) + "\n")
+            journal_file.flush()
+            total_length += length
+            wall = time.time() - started
+            print(f"[{done}/{len(todo)}] {filename} {cues} ({elapsed:.2f}s elapsed, "
+                  f"realtime factor {elapsed / length if length else 0:.3f}; "
+                  f"overall {total_length / wall:.1f}x realtime)", file=sys.stderr)
             print(filename, cues)
@@ -1,52 +1,37 @@
-import boto3
-from botocore.exceptions import ClientError
+import os, sys
 
-def update_mp3_content_types(bucket_name, prefix=''):
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bucket_index
+from maintenance import Maintenance, get_options
+
+def update_mp3_content_types(bucket_name, prefix='', **options):
     """
-    Walk through an S3 bucket, find MP3 files, and ensure correct content type.
+    Find MP3 files in the bucket index, and ensure correct content type.
     
     Args:
         bucket_name (str): Name of the S3 bucket
         prefix (str): Optional prefix/folder path to start from
+        options: Passed to Maintenance, e.g. dry_run
     """
-    s3_client = boto3.client('s3')
-    
-    # Use paginator to handle buckets with many objects
-    paginator = s3_client.get_paginator('list_objects_v2')
+    # The index knows every object's content type, so only the wrong ones
+    # need a request
+    db = bucket_index.sync(details=True, bucket=bucket_name)
+    rows = db.execute(
+        "SELECT key, content_type FROM objects WHERE key LIKE ? AND lower(key) LIKE '%.mp3'",
+        (prefix + '%',)).fetchall()
     
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        if 'Contents' not in page:
-            continue
-            
-        for obj in page['Contents']:
-            key = obj['Key']
+    # Update if content type is not already audio/mpeg
+    keys = []
+    for key, current_content_type in rows:
+        if current_content_type != 'audio/mpeg':
+            print(f"Updating content type for {key} ({current_content_type})")
+            keys.append(key)
             
-            # Check if file has .mp3 extension
-            if not key.lower().endswith('.mp3'):
-                continue
-                
-            try:
-                # Get current object metadata
-                response = s3_client.head_object(Bucket=bucket_name, Key=key)
-                current_content_type = response.get('ContentType', '')
-                
-                # Update if content type is not already audio/mpeg
-                if current_content_type != 'audio/mpeg':
-                    print(f"Updating content type for {key} ({current_content_type})")
-                    s3_client.copy_object(
-                        Bucket=bucket_name,
-                        CopySource={'Bucket': bucket_name, 'Key': key},
-                        Key=key,
-                        MetadataDirective='REPLACE',
-                        ContentType='audio/mpeg',
-                        ACL='public-read',
-                        Metadata=response.get('Metadata', {})
-                    )
-                else:
-                    print(f"Correct content type already set for {key}")
-                    
-            except ClientError as e:
-                print(f"Error processing {key}: {str(e)}")
+    etags = Maintenance(bucket_name, **options).set_content_type(keys, 'audio/mpeg')
+    db.executemany(
+        "UPDATE objects SET content_type = 'audio/mpeg', public_read = 1, etag = ?, details_etag = ? WHERE key = ?",
+        [(etag, etag, key) for key, etag in etags.items()])
+    db.commit()
 
 # Example usage
 if __name__ == "__main__":
@@ -54,4 +39,4 @@ if __name__ == "__main__":
     BUCKET_NAME = "gale8-uk"
     PREFIX = "archive/"  # Optional: specify a folder path
     
-    update_mp3_content_types(BUCKET_NAME, PREFIX)
\ No newline at end of file
+    update_mp3_content_types(BUCKET_NAME, PREFIX, **get_options(sys.argv))
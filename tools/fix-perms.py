@@ -1,11 +1,13 @@
-import boto3, sys
+import os, sys
 
-session = boto3.Session()
-s3 = session.resource('s3')
-bucket = s3.Bucket('gale8-uk')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bucket_index
+from maintenance import Maintenance, get_options
 
-for obj in bucket.objects.all():
-    acl = obj.Acl()
-    if not any(g for g in acl.grants if g["Permission"] == "READ"):
-        print(obj.key, file=sys.stderr)
-        acl.put(ACL='public-read')
+db = bucket_index.sync(details=True)
+keys = [key for key, in db.execute("SELECT key FROM objects WHERE NOT public_read")]
+for key in keys:
+    print(key, file=sys.stderr)
+fixed = Maintenance(bucket_index.BUCKET, **get_options(sys.argv)).set_acl(keys, 'public-read')
+db.executemany("UPDATE objects SET public_read = 1 WHERE key = ?", [(key,) for key in fixed])
+db.commit()
@@ -1,9 +1,8 @@
-import boto3, sys
+import os, sys
 
-session = boto3.Session()
-s3 = session.resource('s3')
-bucket = s3.Bucket('gale8-uk')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bucket_index
 
-for obj in bucket.objects.all():
-    if obj.key.endswith(".mp3"):
-        print(f"{bucket.name},{obj.key}")
+db = bucket_index.sync()
+for key, in db.execute("SELECT key FROM objects WHERE key LIKE '%.mp3' ORDER BY key"):
+    print(f"{bucket_index.BUCKET},{key}")
@@ -0,0 +1,182 @@
+"""Bulk maintenance operations on the archive bucket.
+
+Deletes go 1000 keys to a request. Copies, moves, ACL fixes and content
+type fixes go through a bounded thread pool, and each request is retried
+with exponential backoff if S3 throttles it or fails transiently. Every
+operation can be a dry run, and reports progress as it goes.
+
+For very large ACL or content type fixes, pass manifest= to write an S3
+Batch Operations CSV manifest of the keys instead of making the requests.
+Batch Operations can't delete objects or rename them, so deletes and moves
+always run here.
+
+delete-files.py, move-broken-recordings.py, fix-perms.py and
+fix-content-type.py are front-ends to this.
+"""
+import boto3, random, sys, time
+from botocore.exceptions import ClientError, BotoCoreError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+BUCKET = "gale8-uk"
+BATCH_SIZE = 1000
+retryable = {"SlowDown", "Throttling", "ThrottlingException", "RequestTimeout",
+             "RequestTimeTooSkewed", "InternalError", "ServiceUnavailable", "503", "500"}
+
+class Maintenance:
+    """Runs bulk operations on one bucket.
+
+    Args:
+        workers: How many requests to have in flight at once.
+        dry_run: Print what would be done without doing it.
+        attempts: How many times to try each request.
+        manifest: A path to write a Batch Operations manifest to instead
+            of fixing ACLs or content types.
+    """
+
+    def __init__(self, bucket=BUCKET, workers=16, dry_run=False, attempts=5, manifest=None):
+        self.bucket = bucket
+        self.client = boto3.client("s3")
+        self.workers = workers
+        self.dry_run = dry_run
+        self.attempts = attempts
+        self.manifest = manifest
+        self.failed = {}
+
+    def retry(self, fn, *args, **kwargs):
+        for attempt in range(self.attempts):
+            try:
+                return fn(*args, **kwargs)
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in retryable or attempt == self.attempts - 1:
+                    raise
+            except BotoCoreError:
+                if attempt == self.attempts - 1:
+                    raise
+            time.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+
+    def run(self, description, items, operation):
+        # Applies operation to each item in the pool, returning
+        # {item: result} for the ones that worked
+        items = list(items)
+        results = {}
+        if self.dry_run:
+            for item in items:
+                print(f"dry run: would {description} {item}")
+            return results
+        started = last_report = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.retry, operation, item): item for item in items}
+            for done, future in enumerate(as_completed(futures), 1):
+                item = futures[future]
+                try:
+                    results[item] = future.result()
+                except Exception as e:
+                    print(f"can't {description} {item}: {e}", file=sys.stderr)
+                    self.failed[item] = e
+                if time.time() - last_report > 5 or done == len(items):
+                    last_report = time.time()
+                    print(f"{description}: {done}/{len(items)} done, {done - len(results)} failed "
+                          f"in {last_report - started:.0f} s", file=sys.stderr)
+        return results
+
+    def write_manifest(self, description, keys):
+        with open(self.manifest, "w") as f:
+            for key in keys:
+                f.write(f"{self.bucket},{key}\n")
+        print(f"wrote {len(keys)} keys to {self.manifest} for a Batch Operations job to {description}",
+              file=sys.stderr)
+        return {}
+
+    def delete(self, keys):
+        """Deletes keys, up to 1000 to a request. Returns the keys deleted."""
+        keys = list(keys)
+        batches = [tuple(keys[i:i + BATCH_SIZE]) for i in range(0, len(keys), BATCH_SIZE)]
+
+        def delete_batch(batch):
+            # Keys can fail individually within a request that succeeds,
+            # and those that were throttled are tried again
+            remaining = batch
+            errors = []
+            for attempt in range(self.attempts):
+                response = self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={"Objects": [{"Key": key} for key in remaining], "Quiet": True})
+                throttled = [error for error in response.get("Errors", []) if error["Code"] in retryable]
+                errors += [error for error in response.get("Errors", []) if error["Code"] not in retryable]
+                remaining = [error["Key"] for error in throttled]
+                if not remaining:
+                    break
+                if attempt == self.attempts - 1:
+                    errors += throttled
+                    break
+                time.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+            for error in errors:
+                print(f"can't delete {error['Key']}: {error['Code']} {error.get('Message', '')}", file=sys.stderr)
+                self.failed[error["Key"]] = error
+            failed = {error["Key"] for error in errors}
+            return [key for key in batch if key not in failed]
+
+        if self.dry_run:
+            for key in keys:
+                print(f"dry run: would delete {key}")
+            return []
+        deleted = self.run("delete a batch of", batches, delete_batch)
+        return [key for batch in deleted.values() for key in batch]
+
+    def move(self, moves):
+        """Copies each (source, destination) and then deletes the sources
+        that were copied. Returns the moves that were made."""
+        moves = list(moves)
+        if self.dry_run:
+            for source, destination in moves:
+                print(f"dry run: would move {source} to {destination}")
+            return []
+
+        def copy(move):
+            source, destination = move
+            return self.client.copy_object(
+                Bucket=self.bucket, Key=destination,
+                CopySource={"Bucket": self.bucket, "Key": source})
+        copied = self.run("copy", moves, copy)
+        deleted = set(self.delete(source for source, _ in copied))
+        return [move for move in copied if move[0] in deleted]
+
+    def set_acl(self, keys, acl="public-read"):
+        """Sets the canned ACL of keys. Returns the keys that were set."""
+        keys = list(keys)
+        if self.manifest:
+            return self.write_manifest(f"set the ACL to {acl}", keys)
+
+        def put_acl(key):
+            return self.client.put_object_acl(Bucket=self.bucket, Key=key, ACL=acl)
+        return list(self.run(f"set the ACL to {acl} of", keys, put_acl))
+
+    def set_content_type(self, keys, content_type, acl="public-read"):
+        """Rewrites keys with a new content type, keeping their other
+        metadata. Returns {key: new ETag}."""
+        keys = list(keys)
+        if self.manifest:
+            return self.write_manifest(f"set the content type to {content_type}", keys)
+
+        def rewrite(key):
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+            response = self.client.copy_object(
+                Bucket=self.bucket, Key=key,
+                CopySource={"Bucket": self.bucket, "Key": key},
+                MetadataDirective="REPLACE",
+                ContentType=content_type,
+                ACL=acl,
+                Metadata=head.get("Metadata", {}))
+            return response["CopyObjectResult"]["ETag"]
+        return self.run(f"set the content type to {content_type} of", keys, rewrite)
+
+def get_options(argv):
+    """Parses the options the front-ends share: --dry-run, --workers=N and
+    --manifest=path."""
+    options = {"dry_run": "--dry-run" in argv}
+    for arg in argv:
+        if arg.startswith("--workers="):
+            options["workers"] = int(arg.split("=", 1)[1])
+        elif arg.startswith("--manifest="):
+            options["manifest"] = arg.split("=", 1)[1]
+    return options
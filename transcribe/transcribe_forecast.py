@@ -1,4 +1,6 @@
-import sys, os, time, subprocess, json, tempfile, logging
+import sys, os, io, re, time, subprocess, json, tempfile, logging, math
+import multiprocessing, threading
+from contextlib import contextmanager, closing
 import boto3
 from botocore.exceptions import ClientError
 from vosk import Model, KaldiRecognizer, SetLogLevel
@@ -10,11 +12,33 @@ sample_rate = 16000
 bytes_per_sample = sample_rate * 2
 window_size = bytes_per_sample // 4
 triggers = {"shipping": 0.625, "forecast": 0.625, "bulletin": 0.625, "bbc": 0.5, "radio": 0.5}
+# Restricts a recognizer to the trigger words, with anything else heard as
+# [unk], which finds cues much faster than a full transcription
+keyword_grammar = json.dumps(list(triggers) + ["[unk]"])
 
 def get_config():
     return {
         "bucket": "gale8-uk",
-        "prefix": "cues"
+        "prefix": "cues",
+        # the parts of each recording that a cues_only run recognizes, as
+        # [start, end] in seconds, negative counting back from the end and
+        # None meaning the end. "boundaries" covers the parts in which
+        # get_forecast_cues (in assemble and catalog) looks for the start and
+        # end cues, which depend on the recording's length, and stops once
+        # the end cue is decided: for a 12 minute recording that ends with
+        # "shipping" at 10:40, 510 s of the 720.
+        "cue_windows": "boundaries",
+        # recognize each file in this many chunks at once, each in its own
+        # process; None means one per CPU, or just one when streaming. The
+        # chunks need the length of the audio, so a streamed file is decoded
+        # into memory before any of it is recognized: it only pays off when
+        # there are enough CPUs to make up for that wait.
+        "workers": None,
+        # how much audio each chunk also hears either side of its own
+        "chunk_overlap_secs": 10,
+        # pipe each recording from S3 straight into ffmpeg rather than
+        # downloading it to a file first
+        "stream_input": True
     }
 
 def set_log_level():
@@ -24,30 +48,116 @@ def set_log_level():
 def in_production():
     return os.environ.get("AWS_EXECUTION_ENV") is not None
 
-def recognizer(model_path="/opt/model"):
-    model = Model(model_path)
-    rec = KaldiRecognizer(model, sample_rate)
-    return rec
+# Loaded models and their recognizers by model path, kept for the life of
+# the process so warm invocations and batch tasks don't load them again
+_models = {}
+_recognizers = {}
 
-def detect(rec, filename):
-    if not os.path.exists(filename):
-        raise Error(f"{filename} not found")
+def load_model(model_path="/opt/model"):
+    return Model(model_path)
 
-    process = subprocess.Popen(
-            ['ffmpeg', '-loglevel', 'quiet', '-i',
+def recognizer(model, grammar=None):
+    if grammar is None:
+        return KaldiRecognizer(model, sample_rate)
+    return KaldiRecognizer(model, sample_rate, grammar)
+
+def get_model(model_path="/opt/model"):
+    if model_path not in _models:
+        started = time.time()
+        _models[model_path] = load_model(model_path)
+        logging.info(f"Loaded model {model_path} in {time.time() - started:.1f}s")
+    return _models[model_path]
+
+def get_recognizer(model_path="/opt/model", grammar=None):
+    # recognize() resets the recognizer before each use, so it can be shared
+    if (model_path, grammar) not in _recognizers:
+        _recognizers[model_path, grammar] = recognizer(get_model(model_path), grammar)
+    return _recognizers[model_path, grammar]
+
+def get_workers(config, event, stream=False):
+    workers = event.get("workers", config["workers"])
+    if workers is None and stream:
+        # Recognizes as the stream is decoded rather than waiting for all of it
+        return 1
+    return workers or multiprocessing.cpu_count()
+
+def decode(filename, start=None, duration=None):
+    # Starts ffmpeg decoding filename (or a window of it) to mono PCM
+    seek = []
+    if start:
+        seek += ['-ss', str(start)]
+    if duration is not None:
+        seek += ['-t', str(duration)]
+    return subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'quiet'] + seek + ['-i',
             filename,
             '-ar', str(sample_rate) , '-ac', '1', '-f', 's16le', '-'],
             stdout=subprocess.PIPE)
 
-    cues = {}
+@contextmanager
+def decoded(filename, start=None, duration=None):
+    process = decode(filename, start, duration)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        process.wait()
+
+def feed(body, stdin, errors):
+    # Copies an S3 GET body into ffmpeg as it arrives
+    try:
+        for data in iter(lambda: body.read(1 << 16), b""):
+            stdin.write(data)
+    except BrokenPipeError:
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+@contextmanager
+def decoded_stream(body):
+    # Like decoded(), but reading MP3 from a stream rather than a file
+    process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'quiet', '-f', 'mp3', '-i', 'pipe:0',
+            '-ar', str(sample_rate) , '-ac', '1', '-f', 's16le', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    errors = []
+    feeder = threading.Thread(target=feed, args=(body, process.stdin, errors), daemon=True)
+    feeder.start()
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        process.wait()
+        feeder.join()
+    if errors:
+        raise errors[0]
+
+def get_duration(filename):
+    # ffmpeg with no output file just prints the input's details and fails
+    process = subprocess.run(['ffmpeg', '-hide_banner', '-i', filename],
+            stderr=subprocess.PIPE, text=True)
+    m = re.search(r'Duration: (\d+):(\d+):(\d+\.\d+)', process.stderr)
+    if not m:
+        raise Exception(f"Can't find the duration of {filename}")
+    hours, minutes, seconds = m.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def recognize(rec, pcm, cues, lines, offset=0, line_ends=None, end_boundary=None):
+    # Feeds PCM from pcm to rec, adding trigger cues and transcript lines
+    # timed from offset, and the time each line was completed to line_ends
+    # if given; returns the number of bytes read. With end_boundary it stops
+    # early, once end_cue_found.
     seen = {}
-    lines = []
-    start = time.time()
     bytes_read = line_start = 0
 
     rec.Reset()
     while True:
-        data = process.stdout.read(window_size)
+        data = pcm.read(window_size)
         if len(data) == 0:
             break
         complete = rec.AcceptWaveform(data)
@@ -56,36 +166,233 @@ def detect(rec, filename):
             parsed = json.loads(result)
             text = parsed.get("text")
             if text:
-                lines.append([round(line_start, 3), text])
+                lines.append([round(offset + line_start, 3), text])
+                if line_ends is not None:
+                    line_ends.append(offset + (bytes_read + len(data)) / float(bytes_per_sample))
         else:
             result = rec.PartialResult()
         for trigger, cue_latency in triggers.items():
             if trigger in seen: continue
             if trigger in result:
                 cues.setdefault(trigger, [])
-                cue_start = bytes_read / float(bytes_per_sample) - cue_latency
+                cue_start = offset + bytes_read / float(bytes_per_sample) - cue_latency
                 cues[trigger].append(round(cue_start, 3))
                 seen[trigger] = True
         bytes_read += len(data)
         if complete:
             line_start = bytes_read / bytes_per_sample
             seen = {}
+        if end_boundary is not None and end_cue_found(cues, end_boundary):
+            break
+    return bytes_read
 
-    basename = os.path.basename(filename)
-    return {
-        "file": basename,
+def get_boundaries(length):
+    # The same boundaries as get_forecast_cues: start cues come before
+    # start_boundary and end cues after end_boundary
+    start_boundary = (2.5 if length > 5*60 else 1.5) * 60
+    end_boundary = (5 if length > 9*60 else 3) * 60
+    return start_boundary, end_boundary
+
+def end_cue_found(cues, end_boundary):
+    # get_forecast_cues ends at the first "shipping" at or after
+    # end_boundary whatever else is heard, so nothing after it matters
+    return any(t >= end_boundary for t in cues.get("shipping", ()))
+
+def get_cue_windows(length, margin_secs=10):
+    start_boundary, end_boundary = get_boundaries(length)
+    return [[0, start_boundary + margin_secs], [end_boundary - margin_secs, None]]
+
+def get_windows(windows, length):
+    # Resolves [start, end] pairs where negative times count back from the
+    # end of the file and None means the end, merging any that overlap
+    if windows == "boundaries":
+        windows = get_cue_windows(length)
+    resolved = []
+    for start, end in windows:
+        start = max(0, length + start if start < 0 else start)
+        end = length if end is None else min(length, length + end if end < 0 else end)
+        if end > start:
+            resolved.append([start, end])
+    merged = []
+    for start, end in sorted(resolved):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def get_chunks(spans, workers, overlap_secs):
+    # Splits the spans into about workers chunks of similar length. Each is
+    # (own_start, own_end, read_start, read_end): the chunk reads a little
+    # either side of the part it owns, so words across a boundary are heard
+    # whole by both neighbours and kept only by the one whose part they
+    # start in.
+    total = sum(end - start for start, end in spans)
+    chunks = []
+    for start, end in spans:
+        count = max(1, round(workers * (end - start) / total)) if total else 1
+        size = (end - start) / count
+        for i in range(count):
+            own_start = start + i * size
+            own_end = end if i == count - 1 else own_start + size
+            chunks.append((own_start, own_end,
+                max(start, own_start - overlap_secs), min(end, own_end + overlap_secs)))
+    return chunks
+
+def recognize_chunk(rec, open_pcm, chunk, end_boundary=None):
+    own_start, own_end, read_start, read_end = chunk
+    cues = {}
+    lines = []
+    line_ends = []
+    # Only a cue this chunk keeps can end it early
+    if end_boundary is not None:
+        end_boundary = max(end_boundary, own_start)
+    with open_pcm(read_start, read_end) as pcm:
+        recognize(rec, pcm, cues, lines, read_start, line_ends, end_boundary)
+    # Lines are kept by the chunk they were completed in, since each starts
+    # where the last one ended and the first would otherwise always start
+    # before the part this chunk owns. The first and last chunks of a span
+    # also keep anything timed just outside it.
+    owned = lambda t: (t >= own_start or own_start == read_start) and (t < own_end or own_end == read_end)
+    cues = {trigger: [t for t in times if owned(t)] for trigger, times in cues.items()}
+    return {trigger: times for trigger, times in cues.items() if times}, \
+        [line for line, end in zip(lines, line_ends) if owned(end)]
+
+def chunk_worker(new_recognizer, open_pcm, chunk, conn, end_boundary=None):
+    try:
+        conn.send(recognize_chunk(new_recognizer(), open_pcm, chunk, end_boundary))
+    except Exception as e:
+        conn.send(e)
+    finally:
+        conn.close()
+
+def recognize_parallel(new_recognizer, open_pcm, chunks, cues, lines, dedupe_secs=1, end_boundary=None):
+    # Recognizes each chunk in a forked process with its own recognizer, so
+    # the model (and any decoded audio) the parent has loaded is shared
+    # rather than loaded again.
+    # Lambda has no /dev/shm, which multiprocessing.Pool and Queue need, so
+    # each worker gets a Process and a Pipe.
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for chunk in chunks:
+        parent, child = context.Pipe(duplex=False)
+        process = context.Process(target=chunk_worker,
+            args=(new_recognizer, open_pcm, chunk, child, end_boundary))
+        process.start()
+        child.close()
+        workers.append((process, parent))
+    results = []
+    for process, parent in workers:
+        results.append(parent.recv())
+        process.join()
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+        chunk_cues, chunk_lines = result
+        for trigger, times in chunk_cues.items():
+            cues.setdefault(trigger, []).extend(times)
+        lines.extend(chunk_lines)
+    # Chunks shouldn't both keep the same cue, but if neighbours heard it
+    # at slightly different times only the first is kept
+    for trigger, times in cues.items():
+        deduped = []
+        for t in sorted(times):
+            if not deduped or t - deduped[-1] >= dedupe_secs:
+                deduped.append(t)
+        cues[trigger] = deduped
+    lines.sort(key=lambda line: line[0])
+
+def cues_match(a, b, tolerance=1.0):
+    # Whether two sets of cues found the same triggers within tolerance
+    # seconds of each other, e.g. from serial and parallel recognition
+    if set(a) != set(b):
+        return False
+    for trigger in a:
+        if len(a[trigger]) != len(b[trigger]):
+            return False
+        if any(abs(x - y) > tolerance for x, y in zip(sorted(a[trigger]), sorted(b[trigger]))):
+            return False
+    return True
+
+def recognize_spans(rec, open_pcm, length, windows, workers, new_recognizer, overlap_secs):
+    # Recognizes the windows of the audio (all of it if windows is None),
+    # where open_pcm(start, end) opens the PCM between two times
+    cues = {}
+    lines = []
+    spans = [[0, length]] if windows is None else get_windows(windows, length)
+    end_boundary = get_boundaries(length)[1] if windows == "boundaries" else None
+    if workers > 1 and new_recognizer:
+        recognize_parallel(new_recognizer, open_pcm, get_chunks(spans, workers, overlap_secs), cues, lines,
+                           end_boundary=end_boundary)
+    else:
+        for start, end in spans:
+            with open_pcm(start, end) as pcm:
+                recognize(rec, pcm, cues, lines, start, end_boundary=end_boundary)
+            if end_boundary is not None and end_cue_found(cues, end_boundary):
+                break
+    return cues, lines
+
+def get_detection(name, cues, lines, length, windows):
+    data = {
+        "file": name,
         "cues": cues,
         "transcript": lines,
-        "length": round(bytes_read / float(bytes_per_sample), 3)
+        "length": length
     }
+    if windows is not None:
+        data["partial"] = True
+    return data
+
+def detect(rec, filename, windows=None, workers=1, new_recognizer=None, overlap_secs=10):
+    # Recognizes the whole file, or only the given windows (see
+    # get_windows) in which case the transcript is marked as partial.
+    # With more than one worker, the audio is split into overlapping chunks
+    # recognized in parallel, each with a recognizer from new_recognizer().
+    if not os.path.exists(filename):
+        raise Exception(f"{filename} not found")
+
+    basename = os.path.basename(filename)
+    if windows is None and not (workers > 1 and new_recognizer):
+        cues = {}
+        lines = []
+        with decoded(filename) as pcm:
+            bytes_read = recognize(rec, pcm, cues, lines)
+        return get_detection(basename, cues, lines, round(bytes_read / float(bytes_per_sample), 3), windows)
+
+    length = round(get_duration(filename), 3)
+    open_pcm = lambda start, end: decoded(filename, start, end - start)
+    cues, lines = recognize_spans(rec, open_pcm, length, windows, workers, new_recognizer, overlap_secs)
+    return get_detection(basename, cues, lines, length, windows)
+
+def detect_stream(rec, body, name, windows=None, workers=1, new_recognizer=None, overlap_secs=10):
+    # Like detect(), but decoding MP3 from a stream such as an S3 GET body,
+    # so there's no file to download first. Recognizing the whole stream
+    # with one worker starts on the first bytes; otherwise the windows or
+    # chunks need the length, so the stream is decoded into memory first.
+    if windows is None and not (workers > 1 and new_recognizer):
+        cues = {}
+        lines = []
+        with decoded_stream(body) as pcm:
+            bytes_read = recognize(rec, pcm, cues, lines)
+        return get_detection(name, cues, lines, round(bytes_read / float(bytes_per_sample), 3), windows)
 
-def start_catalog(file, event):
+    with decoded_stream(body) as pcm:
+        audio = pcm.read()
+    length = round(len(audio) / float(bytes_per_sample), 3)
+    offset = lambda secs: int(secs * sample_rate) * 2
+    open_pcm = lambda start, end: io.BytesIO(audio[offset(start):offset(end)])
+    cues, lines = recognize_spans(rec, open_pcm, length, windows, workers, new_recognizer, overlap_secs)
+    return get_detection(name, cues, lines, length, windows)
+
+def start_catalog(entries):
+    # One invocation per batch, so the catalog is written once rather than
+    # racing itself for every file
     lambda_ = boto3.client('lambda')
-    logging.info(f"Initiating catalog of {file}")
+    logging.info(f"Initiating catalog of {len(entries)} files")
     lambda_.invoke(
         FunctionName="catalog-forecast",
         InvocationType="Event",
-        Payload=json.dumps(event)
+        Payload=json.dumps({"files": entries})
     )
 
 def handle_event(event, context):
@@ -94,29 +401,56 @@ def handle_event(event, context):
     bucket = config["bucket"]
     s3 = boto3.client("s3")
     work_dir = tempfile.TemporaryDirectory()
-    logging.info(f"Instantiating speech recognizer")
     model_path = event.get("model", "/opt/model")
-    rec = recognizer(model_path)
+    model = get_model(model_path)
+    # keywords_only listens for just the trigger words, so there's no
+    # transcript, and cues_only recognizes just the parts of each file the
+    # cues come from
+    keywords_only = event.get("keywords_only")
+    grammar = keyword_grammar if keywords_only else None
+    rec = get_recognizer(model_path, grammar)
+    stream = event.get("stream", config["stream_input"])
+    workers = get_workers(config, event, stream)
+    windows = config["cue_windows"] if event.get("cues_only") else None
     cues = {}
-    for mp3_file in event["files"]:
-        filename = os.path.join(work_dir.name, os.path.basename(mp3_file))
-        logging.info(f"Fetching {mp3_file} from {bucket} to {filename}")
-        s3.download_file(config["bucket"], mp3_file, filename)
-        logging.info(f"Extracting transcript from {filename}")
-        data = detect(rec, filename)
-        cue_filename = filename + ".json"
-        logging.info(f"Writing transcript to {cue_filename}")
-        with open(cue_filename, "w") as cue_file:
-           json.dump(data, cue_file)
-        object_name = config["prefix"] + "/" + os.path.basename(cue_filename)
-        logging.info(f"Uploading {cue_filename} to s3://{bucket}/{object_name}")
-        if in_production():
-            s3.upload_file(cue_filename, bucket, object_name, ExtraArgs={'ACL': 'public-read'})
-            if not event.get("skip_catalog"):
-                start_catalog(mp3_file, data) # probably not a race condition?
-        else:
-            logging.info("(not running in production, so not uploading)")
-        cues[mp3_file] = data
+    catalog_entries = []
+    # Files already transcribed are cataloged even if a later one fails
+    try:
+        for mp3_file in event["files"]:
+            filename = os.path.join(work_dir.name, os.path.basename(mp3_file))
+            started = time.time()
+            if stream:
+                logging.info(f"Extracting transcript from s3://{bucket}/{mp3_file} as it downloads")
+                body = s3.get_object(Bucket=bucket, Key=mp3_file)["Body"]
+                with closing(body):
+                    data = detect_stream(rec, body, os.path.basename(mp3_file), windows, workers,
+                        lambda: recognizer(model, grammar), config["chunk_overlap_secs"])
+            else:
+                logging.info(f"Fetching {mp3_file} from {bucket} to {filename}")
+                s3.download_file(config["bucket"], mp3_file, filename)
+                logging.info(f"Extracting transcript from {filename}")
+                data = detect(rec, filename, windows, workers, lambda: recognizer(model, grammar), config["chunk_overlap_secs"])
+            if keywords_only:
+                data["transcript"] = []
+                data["partial"] = True
+            elapsed = time.time() - started
+            logging.info(f"Recognized {data['length']}s of {mp3_file} in {elapsed:.1f}s "
+                         f"({data['length'] / elapsed:.1f}x realtime)")
+            cue_filename = filename + ".json"
+            logging.info(f"Writing transcript to {cue_filename}")
+            with open(cue_filename, "w") as cue_file:
+               json.dump(data, cue_file)
+            object_name = config["prefix"] + "/" + os.path.basename(cue_filename)
+            logging.info(f"Uploading {cue_filename} to s3://{bucket}/{object_name}")
+            if in_production():
+                s3.upload_file(cue_filename, bucket, object_name, ExtraArgs={'ACL': 'public-read'})
+                catalog_entries.append({"file": mp3_file, "cues": data["cues"], "length": data["length"]})
+            else:
+                logging.info("(not running in production, so not uploading)")
+            cues[mp3_file] = data
+    finally:
+        if catalog_entries and not event.get("skip_catalog"):
+            start_catalog(catalog_entries)
     return cues
 
 def handle_batch_event(event, context):
@@ -124,6 +458,10 @@ def handle_batch_event(event, context):
     config = get_config()
     invocation_id = event['invocationId']
     invocation_schema_version = event['invocationSchemaVersion']
+    # Jobs using schema 2.0 can pass e.g. {"cues_only": "true"}
+    user_arguments = event.get("job", {}).get("userArguments") or {}
+    cues_only = str(user_arguments.get("cues_only", "")).lower() == "true"
+    keywords_only = str(user_arguments.get("keywords_only", "")).lower() == "true"
     results = []
 
     for task in event['tasks']:
@@ -135,7 +473,9 @@ def handle_batch_event(event, context):
             obj_key = parse.unquote(task['s3Key'], encoding='utf-8')
             # bucket_name = task['s3BucketArn'].split(':')[-1]
             logging.info("Got task: transcribe %s", obj_key)
-            output = handle_event({"files": [obj_key], "skip_catalog": True}, context)
+            output = handle_event({"files": [obj_key], "skip_catalog": True, "cues_only": cues_only,
+                                   "keywords_only": keywords_only,
+                                   "model": event.get("model", "/opt/model")}, context)
             cues = output[obj_key]["cues"]
             length = output[obj_key]["length"]
             timings = cues.get("shipping", []) + cues.get("forecast", []) + [length]
@@ -169,5 +509,38 @@ if __name__ == "__main__":
             "model": "../detection/model"
             }, {})
         print(result)
+    elif sys.argv[1] == "-p":
+        # Compares serial and parallel recognition of each file
+        model = get_model("../detection/model")
+        workers = multiprocessing.cpu_count()
+        for filename in sys.argv[2:]:
+            started = time.time()
+            serial = detect(recognizer(model), filename)
+            serial_secs = time.time() - started
+            started = time.time()
+            parallel = detect(recognizer(model), filename, None, workers, lambda: recognizer(model))
+            parallel_secs = time.time() - started
+            match = cues_match(serial["cues"], parallel["cues"])
+            print(f"{filename}: serial {serial_secs:.1f}s, {workers} workers {parallel_secs:.1f}s, "
+                  f"cues {'match' if match else 'differ'}")
+            if not match:
+                print(f"  serial: {serial['cues']}\n  parallel: {parallel['cues']}")
+    elif sys.argv[1] == "-k":
+        # Compares full and keyword-only recognition of each file
+        model = get_model("../detection/model")
+        for filename in sys.argv[2:]:
+            started = time.time()
+            full = detect(recognizer(model), filename)
+            full_secs = time.time() - started
+            started = time.time()
+            keywords = detect(recognizer(model, keyword_grammar), filename)
+            keywords_secs = time.time() - started
+            match = cues_match(full["cues"], keywords["cues"])
+            print(f"{filename}: full {full_secs:.1f}s, keywords {keywords_secs:.1f}s, "
+                  f"cues {'match' if match else 'differ'}")
+            if not match:
+                print(f"  full: {full['cues']}\n  keywords: {keywords['cues']}")
+    elif sys.argv[1] == "-c":
+        handle_event({"files": sys.argv[2:], "model": "../detection/model", "cues_only": True}, {})
     else:
         handle_event({"files": sys.argv[1:], "model": "../detection/model"})